@@ -1,8 +1,25 @@
 from datetime import datetime, timedelta, time, date
-from collections import defaultdict, deque
-import calendar
+from collections import defaultdict, deque, namedtuple
+from collections.abc import Mapping
+import bisect
+import contextlib
+import copy
 import csv
+import functools
+import gc
+import hashlib
+import heapq
 import os
+import pickle
+import random
+import sys
+import threading
+import weakref
+
+try:
+    import numpy as np
+except ImportError:  # NumPy optionnel : explosion Python du BOMGraph en repli
+    np = None
 
 # --- Configuration & Parameters ---
 HORIZON_H_MONTHS = 2
@@ -10,6 +27,28 @@ HORIZON_H_WEEKS = 10
 POST_DEFAULT_CAPACITY_HOURS_WEEK = 35
 ADVANCE_RETREAT_WEEKS = 3
 
+# Granularité du calendrier de planification : pas en minutes, ou None pour "shift"
+# (une unité = la journée travaillée complète d'un poste)
+TIME_GRANULARITIES = {"minute": 1, "quarter_hour": 15, "hour": 60, "shift": None}
+SCHEDULING_GRANULARITY = "minute"
+# "forward" : au plus tôt depuis la fenêtre ; "backward" : au plus tard avant la date de besoin
+SCHEDULING_DIRECTIONS = ("forward", "backward")
+SCHEDULING_DIRECTION = "forward"
+# "sequential" : OF par OF dans l'ordre des groupes ; "dispatch" : simulation à événements
+# discrets avec une file d'attente par poste (voir _dispatch_schedule)
+SCHEDULING_ENGINES = ("sequential", "dispatch")
+SCHEDULING_ENGINE = "sequential"
+# Netting usine des stocks après planification (net_inventory_across_groups) au lieu
+# du recalcul de la consommation groupe par groupe
+INVENTORY_NETTING = False
+
+# Cache disque des nomenclatures compilées (clé = hash du contenu du fichier BOM)
+BOM_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+BOM_CACHE_MAX_ENTRIES = 8
+BOM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+BOM_CACHE_FORMAT_VERSION = 4
+PRODUCT_KEY_CACHE_SIZE = 65536   # IDs produits bruts mémorisés par normalize_product_id
+
 def try_parse_float(value):
     """
     Convert numeric strings that may use locale-specific separators into float.
@@ -33,7 +72,8 @@ class ManufacturingOrder:
     def __init__(self, id, designation, product_id, product_type, bom_level, need_date_str, quantity, fg, cat, us, fs, unit="U", status="UNASSIGNED"):
         self.id = id
         self.designation = designation
-        self.product_id = product_id
+        self.product_id = product_id                      # valeur brute, pour la sortie
+        self.product_key = normalize_product_id(product_id)   # ID canonique interné, pour les calculs
         self.product_type = product_type
         self.bom_level = int(bom_level)
         try:
@@ -62,6 +102,14 @@ class ManufacturingOrder:
         # Individual product stock for this specific product line
         self.individual_product_stock = 0
 
+    def reset_planning(self):
+        """Remet l'OF dans l'état d'un OF fraîchement chargé (sans groupe ni planification)."""
+        self.assigned_group_id = None
+        self.status = "UNASSIGNED"
+        self.scheduled_start_date = None
+        self.scheduled_end_date = None
+        self.individual_product_stock = 0
+
     def __repr__(self):
         return (f"OF(id={self.id}, desig='{self.designation}', prod_id='{self.product_id}', type='{self.product_type}', "
                 f"level={self.bom_level}, need={self.need_date.strftime('%Y-%m-%d')}, qty={self.quantity}, "
@@ -73,6 +121,8 @@ class BOMEntry:
     def __init__(self, parent_product_id, child_product_id, quantity_child_per_parent, child_bom_level):
         self.parent_product_id = parent_product_id
         self.child_product_id = child_product_id
+        self.parent_key = normalize_product_id(parent_product_id)
+        self.child_key = normalize_product_id(child_product_id)
         self.quantity_child_per_parent = try_parse_float(quantity_child_per_parent)
         self.child_bom_level = int(child_bom_level)
 
@@ -80,12 +130,386 @@ class BOMEntry:
         return (f"BOM(parent='{self.parent_product_id}' uses {self.quantity_child_per_parent} of child='{self.child_product_id}' "
                 f"at level {self.child_bom_level})")
 
+@functools.lru_cache(maxsize=PRODUCT_KEY_CACHE_SIZE)
+def _product_key(value):
+    return sys.intern(''.join(str(value).replace('\ufeff', '').split()).upper())
+
+def normalize_product_id(value):
+    """
+    Forme canonique d'un ID produit : sans BOM UTF-8, sans blancs, en majuscules.
+    Le résultat est interné et mémorisé par valeur brute (cache LRU borné à
+    PRODUCT_KEY_CACHE_SIZE valeurs) : les OFs et lignes BOM le calculent une fois au
+    chargement (product_key, parent_key, child_key).
+    """
+    if value is None:
+        return ""
+    return _product_key(value)
+
+class BOMGraph:
+    """
+    Nomenclature compilée une seule fois : index parent -> enfants (IDs normalisés),
+    table des niveaux calculée par tri topologique (les cycles sont rejetés)
+    et cache paresseux des explosions multi-niveaux {composant: qty par unité}.
+    """
+    def __init__(self, bom_data):
+        self._bom_data = list(bom_data)
+        self._bom_rows = None
+        self.children = defaultdict(list)   # parent -> [(enfant, qty par parent)]
+        self.parents = defaultdict(set)     # enfant -> {parents}
+        self.declared_premix_ids = set()    # enfants déclarés au niveau 0 (ChildBOMLevel)
+        self.child_rank = {}                # enfant -> 1re ligne BOM où il apparaît
+        self._explosions = {}
+        self._unit_requirements = {}
+        self._families = None
+        self._matrix = None
+        # identifie ce contenu de nomenclature (conservé par pickle) pour les caches des groupes
+        self.cache_token = os.urandom(8).hex()
+
+        for line_no, bom in enumerate(self.bom_data):
+            p = bom.parent_key
+            c = bom.child_key
+            self.children[p].append((c, bom.quantity_child_per_parent))
+            self.parents[c].add(p)
+            self.child_rank.setdefault(c, line_no)
+            if int(bom.child_bom_level) == 0:
+                self.declared_premix_ids.add(c)
+
+        self.parent_ids = set(self.children)
+        self.child_ids = set(self.parents)
+        # premix = feuilles de la nomenclature (jamais parent)
+        self.leaf_ids = self.child_ids - self.parent_ids
+
+        self.topological_order = ()   # parents avant enfants
+        self.levels = {}              # niveau réel, même convention que ChildBOMLevel (feuille = 0)
+        self._levelize()
+
+    def _levelize(self):
+        """
+        Tri topologique (Kahn, O(V+E)) puis calcul des niveaux. Lève ValueError avec
+        le chemin du cycle si la nomenclature est cyclique.
+        """
+        nodes = self.parent_ids | self.child_ids
+        indegree = dict.fromkeys(nodes, 0)
+        for children in self.children.values():
+            for child, _ in children:
+                indegree[child] += 1
+
+        queue = deque(sorted(p for p in nodes if indegree[p] == 0))
+        order = []
+        while queue:
+            prod = queue.popleft()
+            order.append(prod)
+            for child, _ in self.children.get(prod, ()):
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    queue.append(child)
+
+        if len(order) < len(nodes):
+            cycle = self._find_cycle({p for p in nodes if indegree[p] > 0})
+            raise ValueError(
+                f"Cyclic BOM: {' -> '.join(cycle)} "
+                f"({len(nodes) - len(order)} products involved in or below a cycle)."
+            )
+
+        self.topological_order = tuple(order)
+        for prod in reversed(order):
+            self.levels[prod] = 1 + max(
+                (self.levels[child] for child, _ in self.children.get(prod, ())),
+                default=-1
+            )
+
+        mismatches = []
+        for bom in self.bom_data:
+            child = bom.child_key
+            if bom.child_bom_level != self.levels[child]:
+                mismatches.append((child, bom.child_bom_level, self.levels[child]))
+        if mismatches:
+            examples = ", ".join(f"{c} (declared {d}, computed {l})" for c, d, l in mismatches[:5])
+            print(f"Warning: {len(mismatches)} BOM lines have a ChildBOMLevel inconsistent with the structure: {examples}")
+
+    def _find_cycle(self, remaining):
+        """
+        Remonte un cycle parmi les produits restés hors du tri topologique : chacun
+        a au moins un parent restant, donc la remontée finit par boucler.
+        """
+        prod = min(remaining)
+        seen = {}
+        path = []
+        while prod not in seen:
+            seen[prod] = len(path)
+            path.append(prod)
+            prod = min(p for p in self.parents[prod] if p in remaining)
+        cycle = path[seen[prod]:] + [prod]
+        cycle.reverse()   # sens parent -> enfant
+        return cycle
+
+    def families(self):
+        """
+        Familles de produits : composantes connexes de la nomenclature (union-find).
+        Retourne {produit: identifiant de famille}, l'identifiant étant le plus petit ID.
+        """
+        if self._families is not None:
+            return self._families
+        root = {p: p for p in self.topological_order}
+
+        def find(p):
+            while root[p] != p:
+                root[p] = root[root[p]]
+                p = root[p]
+            return p
+
+        for parent, children in self.children.items():
+            for child, _ in children:
+                a, b = find(parent), find(child)
+                if a != b:
+                    if b < a:
+                        a, b = b, a
+                    root[b] = a
+        self._families = {p: find(p) for p in root}
+        return self._families
+
+    def precompute(self):
+        """Remplit les caches persistés sur disque (explosions, familles)."""
+        for prod in reversed(self.topological_order):
+            self.explode(prod)
+        self.families()
+        return self
+
+    @property
+    def bom_data(self):
+        # après lecture du cache disque, les BOMEntry ne sont recréés qu'à la demande
+        if self._bom_data is None:
+            self._bom_data = [BOMEntry(*row) for row in self._bom_rows]
+            self._bom_rows = None
+        return self._bom_data
+
+    def to_state(self):
+        """
+        État en types natifs uniquement (aucune classe du module) : c'est ce dict, et non
+        l'instance, qui est écrit dans le cache disque, lisible que le module ait été
+        chargé comme sothemalgo_grouper (web) ou comme __main__ (CLI).
+        """
+        state = dict(self.__dict__)
+        state["_bom_data"] = None
+        state["_bom_rows"] = [
+            (b.parent_product_id, b.child_product_id, b.quantity_child_per_parent, b.child_bom_level)
+            for b in self.bom_data
+        ]
+        state["children"] = dict(self.children)
+        state["parents"] = dict(self.parents)
+        state["_unit_requirements"] = {}   # recalculé à la demande depuis les explosions
+        state["_matrix"] = None
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Reconstruit un BOMGraph depuis to_state()."""
+        bom_graph = cls.__new__(cls)
+        bom_graph.__setstate__(dict(state))
+        return bom_graph
+
+    def __getstate__(self):
+        return self.to_state()
+
+    def __setstate__(self, state):
+        state["children"] = defaultdict(list, state["children"])
+        state["parents"] = defaultdict(set, state["parents"])
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self._bom_rows) if self._bom_data is None else len(self._bom_data)
+
+    def explode(self, product_id):
+        """
+        Explosion complète d'un produit : {composant: qty par unité}, tous niveaux.
+        Le dict retourné est partagé par le cache, ne pas le modifier.
+        """
+        prod = normalize_product_id(product_id)
+        cached = self._explosions.get(prod)
+        if cached is not None:
+            return cached
+        # nomenclature acyclique (vérifiée par _levelize) : récursion bornée par la profondeur
+        totals = {}
+        for child, qty in self.children.get(prod, ()):
+            totals[child] = totals.get(child, 0.0) + qty
+            for comp, comp_qty in self.explode(child).items():
+                totals[comp] = totals.get(comp, 0.0) + qty * comp_qty
+        self._explosions[prod] = totals
+        return totals
+
+    def qty_of_component(self, product_id, component_id):
+        prod = normalize_product_id(product_id)
+        comp = normalize_product_id(component_id)
+        if prod == comp:
+            return 1.0
+        return self.explode(prod).get(comp, 0.0)
+
+    def unit_requirements(self, product_id):
+        """
+        [(composant, qty par unité)] avec qty > 0, dans l'ordre des lignes BOM comme
+        l'ancien balayage de bom_data. Le produit lui-même est inclus (qty 1.0)
+        s'il est enfant d'une ligne BOM.
+        """
+        prod = normalize_product_id(product_id)
+        cached = self._unit_requirements.get(prod)
+        if cached is not None:
+            return cached
+        per_unit = dict(self.explode(prod))
+        if prod in self.child_ids:
+            per_unit[prod] = per_unit.get(prod, 0.0) + 1.0
+        result = tuple(sorted(
+            ((comp, qty) for comp, qty in per_unit.items() if qty > 0),
+            key=lambda item: self.child_rank[item[0]]
+        ))
+        self._unit_requirements[prod] = result
+        return result
+
+    def requirements(self, product_id, quantity=1.0):
+        """Besoins composants {composant: qty} pour `quantity` unités du produit."""
+        return {comp: qty * quantity for comp, qty in self.unit_requirements(product_id)}
+
+    def batch_requirements(self, ofs):
+        """
+        Besoins composants de tous les OFs d'un coup : liste de {composant: qty}, dans
+        l'ordre de ofs. Utilise la matrice creuse NumPy si disponible, sinon l'explosion Python.
+        """
+        if np is not None:
+            if self._matrix is None:
+                self._matrix = BOMMatrix(self)
+            return self._matrix.requirements_for_orders(ofs)
+        return [self.requirements(of.product_key, of.quantity) for of in ofs]
+
+class BOMMatrix:
+    """
+    Nomenclature sous forme de matrice creuse produit×produit (format CSR en tableaux
+    NumPy : indptr/indices/data). Les explosions de tous les OFs se font par
+    propagation niveau par niveau sur la matrice, sans boucle Python par OF.
+    """
+    def __init__(self, bom_graph):
+        self.bom_graph = bom_graph
+        self.product_ids = sorted(bom_graph.parent_ids | bom_graph.child_ids)
+        self.index = {p: i for i, p in enumerate(self.product_ids)}
+        n = len(self.product_ids)
+
+        parent_idx, child_idx, qtys = [], [], []
+        for parent, children in bom_graph.children.items():
+            for child, qty in children:
+                parent_idx.append(self.index[parent])
+                child_idx.append(self.index[child])
+                qtys.append(qty)
+        parent_idx = np.asarray(parent_idx, dtype=np.int64)
+        order = np.argsort(parent_idx, kind="stable")
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent_idx, minlength=n), out=self.indptr[1:])
+        self.indices = np.asarray(child_idx, dtype=np.int64)[order]
+        self.data = np.asarray(qtys, dtype=np.float64)[order]
+
+        # rang de 1re apparition comme enfant (ordre des lignes BOM), -1 si jamais enfant
+        self.child_rank = np.full(n, -1, dtype=np.int64)
+        for child, rank in bom_graph.child_rank.items():
+            self.child_rank[self.index[child]] = rank
+
+    def _multiply(self, rows, cols, vals):
+        """Un pas de propagation : (lignes, produits, qty) × Q -> triplets des enfants."""
+        starts = self.indptr[cols]
+        counts = self.indptr[cols + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return None
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        pos = np.repeat(starts, counts) + (np.arange(total) - first)
+        return np.repeat(rows, counts), self.indices[pos], np.repeat(vals, counts) * self.data[pos]
+
+    def _coalesce(self, rows, cols, vals):
+        n = len(self.product_ids)
+        keys, inverse = np.unique(rows * n + cols, return_inverse=True)
+        return keys // n, keys % n, np.bincount(inverse, weights=vals)
+
+    def explode(self, product_idx):
+        """
+        Explosion unitaire multi-niveaux de plusieurs produits : triplets COO
+        (ligne dans product_idx, composant, qty par unité). Le nombre de pas est
+        borné par le niveau maximal, le BOMGraph ayant déjà rejeté les cycles.
+        """
+        rows = np.arange(len(product_idx), dtype=np.int64)
+        frontier = (rows, np.asarray(product_idx, dtype=np.int64), np.ones(len(product_idx)))
+        acc_rows, acc_cols, acc_vals = [], [], []
+        while True:
+            step = self._multiply(*frontier)
+            if step is None:
+                break
+            frontier = self._coalesce(*step)
+            acc_rows.append(frontier[0])
+            acc_cols.append(frontier[1])
+            acc_vals.append(frontier[2])
+        if not acc_rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        return self._coalesce(np.concatenate(acc_rows), np.concatenate(acc_cols), np.concatenate(acc_vals))
+
+    def requirements_for_orders(self, ofs):
+        """
+        Besoins de tous les OFs en une opération : diag(qty) · P(OF->produit) · E,
+        E étant l'explosion unitaire. Liste alignée sur ofs ; même contenu et même ordre
+        de clés que BOMGraph.requirements.
+        """
+        ofs = list(ofs)
+        known = sorted({of.product_key for of in ofs if of.product_key in self.index})
+        if not known:
+            # aucun produit des OFs dans la nomenclature : pas de besoins
+            return [{} for _ in ofs]
+        known_idx = np.asarray([self.index[p] for p in known], dtype=np.int64)
+        u_rows, u_cols, u_vals = self.explode(known_idx)
+
+        # le produit lui-même compte pour 1.0 s'il est enfant d'une ligne BOM
+        self_rows = np.nonzero(self.child_rank[known_idx] >= 0)[0]
+        u_rows, u_cols, u_vals = self._coalesce(
+            np.concatenate([u_rows, self_rows]),
+            np.concatenate([u_cols, known_idx[self_rows]]),
+            np.concatenate([u_vals, np.ones(len(self_rows))]),
+        )
+        keep = u_vals > 0
+        u_rows, u_cols, u_vals = u_rows[keep], u_cols[keep], u_vals[keep]
+        order = np.lexsort((self.child_rank[u_cols], u_rows))
+        u_rows, u_cols, u_vals = u_rows[order], u_cols[order], u_vals[order]
+        u_indptr = np.zeros(len(known) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(u_rows, minlength=len(known)), out=u_indptr[1:])
+
+        row_of_product = {p: i for i, p in enumerate(known)}
+        of_rows = np.asarray([row_of_product.get(of.product_key, -1) for of in ofs], dtype=np.int64)
+        of_qtys = np.asarray([of.quantity for of in ofs], dtype=np.float64)
+        valid = of_rows >= 0
+        safe_rows = np.where(valid, of_rows, 0)
+        counts = np.where(valid, u_indptr[safe_rows + 1] - u_indptr[safe_rows], 0)
+        total = int(counts.sum())
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        pos = np.repeat(u_indptr[safe_rows], counts) + (np.arange(total) - first)
+        comp_cols = u_cols[pos]
+        comp_vals = u_vals[pos] * np.repeat(of_qtys, counts)
+
+        result = []
+        comp_names = [self.product_ids[c] for c in comp_cols.tolist()]
+        comp_vals = comp_vals.tolist()
+        offset = 0
+        for count in counts.tolist():
+            result.append(dict(zip(comp_names[offset:offset + count], comp_vals[offset:offset + count])))
+            offset += count
+        return result
+
+def as_bom_graph(bom):
+    """Accepte une liste de BOMEntry ou un BOMGraph déjà compilé."""
+    if isinstance(bom, BOMGraph):
+        return bom
+    return BOMGraph(bom or [])
+
 class Group:
     def __init__(self, id, ps_product_id, initial_ps_of, window_start_date, window_end_date):
         self.id = id
         self.ps_product_id = ps_product_id
         self.time_window_start = window_start_date
         self.time_window_end = window_end_date
+        self._version = 0                 # incrémenté à chaque changement de composition
+        self._consumption_cache = None    # ((version, BOM), résultats de calculate_consumption)
         self.ofs = []
         self.current_ps_stock_available = 0
         self.component_stocks = {}
@@ -98,8 +522,18 @@ class Group:
         
         self.add_of(initial_ps_of, ps_quantity_change=initial_ps_of.quantity)
 
+    @property
+    def ofs(self):
+        return self._ofs
+
+    @ofs.setter
+    def ofs(self, ofs):
+        self._ofs = ofs
+        self._version += 1
+
     def add_of(self, of_to_add, ps_quantity_change=0):
-        self.ofs.append(of_to_add)
+        self._ofs.append(of_to_add)
+        self._version += 1
         self.current_ps_stock_available += ps_quantity_change
         
         # Update component stocks (balance-style tracker)
@@ -118,82 +552,91 @@ class Group:
         of_to_add.assigned_group_id = self.id
         of_to_add.status = "ASSIGNED"
 
-    def calculate_consumption(self, bom_data):
+    def calculate_consumption(self, bom_data, ledger=None):
         """
         Recalcule les stocks restants par OF avec FIFO, en normalisant violemment les IDs produit.
+        `bom_data` peut être le BOMGraph partagé (recommandé) ou une liste de BOMEntry.
+        Les lots sont des paires [of_id, reste] et la disponibilité de chaque composant
+        est tenue à jour au fil des productions/consommations : coût linéaire en lots.
+        Tant que la composition du groupe et la nomenclature n'ont pas changé, les
+        résultats du calcul précédent sont réappliqués sans recalcul.
+        Avec un InventoryLedger, les besoins sont d'abord servis par le stock usine
+        disponible à la date de l'OF, puis le surplus du groupe y est reversé (pas de cache).
         """
-        from collections import defaultdict, deque
-
-        # --- 1. normalisation super agressive ---
-        def norm(x):
-            if x is None:
-                return ""
-            s = str(x)
-            s = s.replace('\ufeff', '')  # BOM éventuel
-            # enlève TOUS les espaces/blancs (même insécables)
-            s = ''.join(s.split())
-            s = s.upper()
-            return s
+        bom_graph = as_bom_graph(bom_data)
+
+        cache_key = (self._version, bom_graph.cache_token)
+        if ledger is None and self._consumption_cache is not None and self._consumption_cache[0] == cache_key:
+            _, of_stocks, product_consumption, individual_product_stocks, component_stocks = self._consumption_cache
+            for of, stock in zip(self.ofs, of_stocks):
+                of.individual_product_stock = stock
+            self.product_consumption = dict(product_consumption)
+            self.individual_product_stocks = dict(individual_product_stocks)
+            self.component_stocks = dict(component_stocks)
+            return
 
         print(f"[CONSUMP] === Calcul consommation pour le groupe {self.id} ===")
 
-        # --- 2. indexer la nomenclature avec IDs normalisés ---
-        bom_lookup = defaultdict(list)
-        parents = set()
-        children = set()
-        for bom in bom_data:
-            p = norm(bom.parent_product_id)
-            c = norm(bom.child_product_id)
-            bom_lookup[p].append((c, bom.quantity_child_per_parent))
-            parents.add(p)
-            children.add(c)
-
-        premix_products = {c for c in children if c not in parents}
+        # --- 2. nomenclature indexée une fois par le BOMGraph ---
+        bom_lookup = bom_graph.children
+        levels = bom_graph.levels   # niveau 0 = premix (feuille)
         type_priority = {"PS": 0, "SF": 1, "PF": 2}
 
+        # IDs canoniques calculés au chargement
+        group_entries = [(of, of.product_key) for of in self.ofs]
+
         # log des OFs du groupe
         print("[CONSUMP] OFs dans le groupe :")
-        for of in self.ofs:
-            print(f"    - {of.id} | prod={norm(of.product_id)} | qty={of.quantity} | date={of.need_date.strftime('%Y-%m-%d')}")
+        for of, prod_id in group_entries:
+            print(f"    - {of.id} | prod={prod_id} | qty={of.quantity} | date={of.need_date.strftime('%Y-%m-%d')}")
+
+        # le niveau de l'OF (CAT) reste la clé de tri ; on signale seulement les écarts avec la nomenclature
+        mismatches = [
+            (of.id, of.bom_level, levels[prod_id])
+            for of, prod_id in group_entries
+            if prod_id in levels and levels[prod_id] != of.bom_level
+        ]
+        if mismatches:
+            examples = ", ".join(f"{o} (declared {d}, computed {l})" for o, d, l in mismatches[:5])
+            print(f"[CONSUMP] Warning: {len(mismatches)} OFs have a level inconsistent with the BOM: {examples}")
 
         # --- 3. ordre de traitement : premix d'abord, puis par niveau/date/type ---
-        sorted_ofs = sorted(
-            self.ofs,
-            key=lambda of: (
-                0 if norm(of.product_id) in premix_products else 1,
-                of.bom_level,
-                of.need_date,
-                type_priority.get(of.product_type, 3),
+        sorted_entries = sorted(
+            group_entries,
+            key=lambda entry: (
+                0 if levels.get(entry[1]) == 0 else 1,
+                entry[0].bom_level,
+                entry[0].need_date,
+                type_priority.get(entry[0].product_type, 3),
             )
         )
 
-        fifo_supply = defaultdict(deque)   # produit → deque de {of_id, remaining}
+        fifo_supply = defaultdict(deque)   # produit → deque de lots [of_id, reste]
+        available = defaultdict(float)     # produit → somme des restes de ses lots
         remaining_per_of = {of.id: 0.0 for of in self.ofs}
         product_produced = defaultdict(float)
         product_consumption = defaultdict(float)
         component_balance = defaultdict(float)
         production_status = {}
+        ledger_drawn = defaultdict(float)  # composant → quantité prise au stock usine
         EPS = 1e-9
 
         # --- 4. boucle principale ---
-        for of in sorted_ofs:
-            prod_id = norm(of.product_id)
+        for of, prod_id in sorted_entries:
             qty = float(of.quantity)
 
             # besoins composants de CE produit
             components_needed = {}
-            for child_id, q_child in bom_lookup.get(prod_id, []):
+            for child_id, q_child in bom_lookup.get(prod_id, ()):
                 need = q_child * qty
                 if need > EPS:
                     components_needed[child_id] = components_needed.get(child_id, 0.0) + need
 
             # check dispo
-            can_produce = True
-            for comp_id, req in components_needed.items():
-                available = sum(e["remaining"] for e in fifo_supply.get(comp_id, []))
-                if available + EPS < req:
-                    can_produce = False
-                    break
+            can_produce = all(
+                available[comp_id] + (ledger.available(comp_id, of.need_date) if ledger else 0.0) + EPS >= req
+                for comp_id, req in components_needed.items()
+            )
 
             if not can_produce:
                 print(f"    -> pas assez de composants pour OF {of.id} ({prod_id}) : NON PRODUIT")
@@ -208,32 +651,44 @@ class Group:
             for comp_id, req in components_needed.items():
                 need_left = req
                 print(f"    consommation FIFO pour OF {of.id}: besoin composant {comp_id} = {req:.6f}")
-                while need_left > EPS and fifo_supply.get(comp_id):
-                    entry = fifo_supply[comp_id][0]
-                    take = min(entry["remaining"], need_left)
-                    entry["remaining"] -= take
+                if ledger:
+                    for supplier_of, take in ledger.draw(comp_id, need_left, of.need_date):
+                        need_left -= take
+                        ledger_drawn[comp_id] += take
+                        supplier_of.individual_product_stock = max(0.0, supplier_of.individual_product_stock - take)
+                        print(f"        prend {take:.6f} depuis le stock usine (OF {supplier_of.id})")
+                lots = fifo_supply[comp_id]
+                while need_left > EPS and lots:
+                    lot = lots[0]
+                    take = min(lot[1], need_left)
+                    lot[1] -= take
                     need_left -= take
-                    remaining_per_of[entry["of_id"]] -= take
-                    print(f"        prend {take:.6f} depuis OF {entry['of_id']} (reste sur ce lot={entry['remaining']:.6f})")
-                    if entry["remaining"] <= EPS:
-                        fifo_supply[comp_id].popleft()
+                    available[comp_id] -= take
+                    remaining_per_of[lot[0]] -= take
+                    print(f"        prend {take:.6f} depuis OF {lot[0]} (reste sur ce lot={lot[1]:.6f})")
+                    if lot[1] <= EPS:
+                        available[comp_id] -= lot[1]
+                        lots.popleft()
                 product_consumption[comp_id] += req
                 component_balance[comp_id] -= req
 
             # produire cet OF
-            fifo_supply[prod_id].append({"of_id": of.id, "remaining": qty})
+            fifo_supply[prod_id].append([of.id, qty])
+            available[prod_id] += qty
             remaining_per_of[of.id] += qty
             component_balance[prod_id] += qty
             product_produced[prod_id] += qty
             print(f"    => produit {qty} de {prod_id} (lot OF {of.id})")
 
         # --- 5. répartition finale par produit (FIFO) ---
+        ofs_by_product = defaultdict(list)
+        for of, prod_id in sorted_entries:
+            ofs_by_product[prod_id].append(of)
         for prod_id, total_prod in product_produced.items():
-            total_cons = product_consumption.get(prod_id, 0.0)
+            total_cons = product_consumption.get(prod_id, 0.0) - ledger_drawn.get(prod_id, 0.0)
             must_remain = max(0.0, total_prod - total_cons)
 
-            ofs_of_prod = [of for of in sorted_ofs if norm(of.product_id) == prod_id]
-            for of in ofs_of_prod:
+            for of in ofs_by_product[prod_id]:
                 cur = max(0.0, remaining_per_of[of.id])
                 if must_remain <= 0:
                     remaining_per_of[of.id] = 0.0
@@ -244,7 +699,7 @@ class Group:
 
         # --- 6. écrire dans les OFs ---
         print("\n[CONSUMP] Stocks finaux par OF (c’est CE chiffre qui doit aller dans le fichier) :")
-        for of in self.ofs:
+        for of, prod_id in group_entries:
             if not production_status.get(of.id, False):
                 of.individual_product_stock = 0.0
             else:
@@ -252,57 +707,642 @@ class Group:
                 # borne au qty de l’OF
                 rem = min(rem, of.quantity)
                 of.individual_product_stock = rem
-            print(f"    OF {of.id} ({norm(of.product_id)}) => stock restant = {of.individual_product_stock}")
+            print(f"    OF {of.id} ({prod_id}) => stock restant = {of.individual_product_stock}")
 
         # agrégats pour le groupe
         self.product_consumption = dict(product_consumption)
-        self.individual_product_stocks = {
-            pid: sum(
-                max(0.0, remaining_per_of[o.id])
-                for o in self.ofs
-                if norm(o.product_id) == pid
-            )
-            for pid in {norm(o.product_id) for o in self.ofs}
-        }
+        individual_product_stocks = {}
+        for of, prod_id in group_entries:
+            individual_product_stocks[prod_id] = individual_product_stocks.get(prod_id, 0) + max(0.0, remaining_per_of[of.id])
+        self.individual_product_stocks = individual_product_stocks
         self.component_stocks = dict(component_balance)
+        if ledger is None:
+            self._consumption_cache = (
+                cache_key,
+                [of.individual_product_stock for of in self.ofs],
+                dict(self.product_consumption),
+                dict(self.individual_product_stocks),
+                dict(self.component_stocks),
+            )
+        else:
+            # les stocks dépendent désormais des autres groupes
+            self._consumption_cache = None
+            for of in self.ofs:
+                if of.individual_product_stock > EPS:
+                    ledger.deposit(of, of.individual_product_stock)
 
         print(f"[CONSUMP] === Fin calcul groupe {self.id} ===\n")
 
 
+def _minute_index(dt_obj):
+    """Minute absolue (ordinal du jour * 1440 + minute du jour), secondes ignorées."""
+    return dt_obj.toordinal() * 1440 + dt_obj.hour * 60 + dt_obj.minute
+
+def _minute_datetime(minute_idx):
+    day, minute = divmod(minute_idx, 1440)
+    return datetime.fromordinal(day) + timedelta(minutes=minute)
+
+def time_granularity_step(granularity):
+    """Pas en minutes d'une granularité (nom de TIME_GRANULARITIES ou diviseur de 1440) ; None pour "shift"."""
+    if isinstance(granularity, str) and granularity in TIME_GRANULARITIES:
+        return TIME_GRANULARITIES[granularity]
+    if isinstance(granularity, int) and not isinstance(granularity, bool) and granularity > 0 and 1440 % granularity == 0:
+        return granularity
+    raise ValueError(f"Unknown time granularity {granularity!r}. Expected one of {list(TIME_GRANULARITIES)} or a divisor of 1440 minutes.")
+
+class ShiftTemplate:
+    """
+    Journée type d'un poste : horaires et pause déjeuner réduits aux segments travaillés
+    d'un jour ouvré, et capacité journalière. Partagée par tous les postes de mêmes
+    horaires (voir shift_template).
+    """
+    def __init__(self, work_start, work_end, lunch_start, lunch_end):
+        self.key = (work_start, work_end, lunch_start, lunch_end)
+        ws = work_start.hour * 60 + work_start.minute
+        we = work_end.hour * 60 + work_end.minute
+        ls = lunch_start.hour * 60 + lunch_start.minute
+        le = lunch_end.hour * 60 + lunch_end.minute
+        # segments travaillés d'un jour ouvré, en minutes du jour
+        day_segments = []
+        if we > ws:
+            if le > ls and ls < we and le > ws:
+                if ls > ws:
+                    day_segments.append((ws, ls))
+                if we > le:
+                    day_segments.append((le, we))
+            else:
+                day_segments.append((ws, we))
+        self.day_segments = tuple(day_segments)
+
+        # Calculate effective work hours per day
+        ws_dt = datetime.combine(date.min, work_start)
+        we_dt = datetime.combine(date.min, work_end)
+        ls_dt = datetime.combine(date.min, lunch_start)
+        le_dt = datetime.combine(date.min, lunch_end)
+
+        self.daily_capacity_hours = 0
+        if we_dt > ws_dt:
+            total_work_seconds = (we_dt - ws_dt).total_seconds()
+            lunch_seconds = 0
+            # Check for a valid lunch break that is within work hours
+            if le_dt > ls_dt and ls_dt >= ws_dt and le_dt <= we_dt:
+                lunch_seconds = (le_dt - ls_dt).total_seconds()
+            self.daily_capacity_hours = max(0, (total_work_seconds - lunch_seconds) / 3600.0)
+
+_SHIFT_TEMPLATES = {}
+_CALENDAR_TEMPLATES = weakref.WeakValueDictionary()
+
+def shift_template(work_start, work_end, lunch_start, lunch_end):
+    key = (work_start, work_end, lunch_start, lunch_end)
+    template = _SHIFT_TEMPLATES.get(key)
+    if template is None:
+        template = _SHIFT_TEMPLATES[key] = ShiftTemplate(*key)
+    return template
+
+def working_calendar(shift, unavailable_periods=(), granularity=SCHEDULING_GRANULARITY):
+    """
+    Calendrier compilé partagé : un seul objet par (horaires, ensemble d'indisponibilités,
+    granularité). Les postes aux mêmes horaires partagent le ShiftTemplate ; leurs
+    indisponibilités propres s'y superposent, et les postes d'indisponibilités identiques
+    partagent le calendrier compilé. Les calendriers inutilisés sont libérés (registre faible).
+    """
+    step = time_granularity_step(granularity)
+    key = (shift.key, tuple(sorted(set(unavailable_periods))), step)
+    working_cal = _CALENDAR_TEMPLATES.get(key)
+    if working_cal is None:
+        working_cal = WorkingCalendar(shift, key[1], granularity)
+        _CALENDAR_TEMPLATES[key] = working_cal
+    return working_cal
+
+def _synchronized(method):
+    # lecture des tables compilées sous le verrou du calendrier : une compilation
+    # paresseuse (_cover) peut les reconstruire pendant qu'un autre thread les lit
+    @functools.wraps(method)
+    def locked(self, *args):
+        with self._lock:
+            return method(self, *args)
+    return locked
+
+class WorkingCalendar:
+    """
+    Calendrier de travail compilé : journée type, week-ends et indisponibilités
+    réduits à des intervalles d'unités travaillées triés, avec le nombre cumulé d'unités
+    travaillées avant chaque intervalle. Ajouter N unités de travail à une date revient
+    à deux bisect. Les jours sont compilés à la demande, mais le calendrier ne change
+    jamais de sens : il peut être partagé entre postes (working_calendar), y compris
+    entre les threads du serveur web, les accès aux tables compilées étant sérialisés
+    par un verrou.
+
+    L'unité est fixée par la granularité : la minute par défaut, le quart d'heure,
+    l'heure (seules les unités entièrement travaillées comptent), ou "shift" où l'unité
+    d'index d est la journée travaillée du jour ordinal d, utilisable seulement si elle
+    est entièrement disponible.
+    """
+    def __init__(self, shift, unavailable_periods=(), granularity=SCHEDULING_GRANULARITY):
+        self.shift = shift
+        self.day_segments = shift.day_segments
+        self.granularity = granularity
+        self.step = time_granularity_step(granularity)
+        if self.step is None:
+            self.unit_minutes = sum(end - start for start, end in self.day_segments)
+            self._shift_start = self.day_segments[0][0] if self.day_segments else 0
+            self._shift_end = self.day_segments[-1][1] if self.day_segments else 0
+        else:
+            self.unit_minutes = self.step
+
+        # minutes indisponibles [début, fin) fusionnées ; une période (début, fin) couvre
+        # les minutes m telles que début <= m <= fin
+        periods = []
+        for un_start, un_end in sorted(unavailable_periods):
+            start_idx = _minute_index(un_start) + (1 if (un_start.second or un_start.microsecond) else 0)
+            end_idx = _minute_index(un_end) + 1
+            if end_idx <= start_idx:
+                continue
+            if periods and start_idx <= periods[-1][1]:
+                periods[-1][1] = max(periods[-1][1], end_idx)
+            else:
+                periods.append([start_idx, end_idx])
+        self._unavailable_starts = [p[0] for p in periods]
+        self._unavailable_ends = [p[1] for p in periods]
+        # au-delà de la dernière indisponibilité (en deçà de la première en remontant le
+        # temps), une semaine suffit à trouver du travail
+        self._last_unavailable_day = periods[-1][1] // 1440 if periods else None
+        self._first_unavailable_day = periods[0][0] // 1440 if periods else None
+
+        self._first_day = None
+        self._end_day = None
+        self._starts = []
+        self._ends = []
+        self._cum_ends = []   # unités travaillées cumulées à la fin de chaque intervalle
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def unit_index(self, dt_obj):
+        """Première frontière d'unité à partir de dt_obj (secondes ignorées)."""
+        minute_idx = _minute_index(dt_obj)
+        if self.step is None:
+            day, minute = divmod(minute_idx, 1440)
+            return day if minute <= self._shift_start else day + 1
+        return -(-minute_idx // self.step)
+
+    def end_unit_index(self, dt_obj):
+        """Dernière frontière de fin d'unité au plus tard à dt_obj."""
+        minute_idx = _minute_index(dt_obj)
+        if self.step is None:
+            day, minute = divmod(minute_idx, 1440)
+            return day + 1 if minute >= self._shift_end else day
+        return minute_idx // self.step
+
+    def unit_floor(self, dt_obj):
+        """Unité contenant dt_obj."""
+        if self.step is None:
+            return dt_obj.toordinal()
+        return _minute_index(dt_obj) // self.step
+
+    def unit_start(self, unit):
+        """Date de début de l'unité `unit`."""
+        if self.step is None:
+            return _minute_datetime(unit * 1440 + self._shift_start)
+        return _minute_datetime(unit * self.step)
+
+    def unit_end(self, unit):
+        """Date de fin d'un travail qui s'achève à la frontière d'unité `unit`."""
+        if self.step is None:
+            return _minute_datetime((unit - 1) * 1440 + self._shift_end)
+        return _minute_datetime(unit * self.step)
+
+    def duration_units(self, minutes):
+        """Unités entamées par un travail de `minutes` minutes."""
+        if self.unit_minutes <= 0:
+            return minutes
+        return -(-minutes // self.unit_minutes)
+
+    def _unit_day(self, unit):
+        return unit if self.step is None else unit * self.step // 1440
+
+    def _day_intervals(self, day):
+        if self.step is None:
+            # la journée n'est une unité que si toute sa plage de travail est disponible
+            if self.unit_minutes and sum(end - start for start, end in self._day_minute_intervals(day)) == self.unit_minutes:
+                yield day, day + 1
+        elif self.step == 1:
+            yield from self._day_minute_intervals(day)
+        else:
+            for start, end in self._day_minute_intervals(day):
+                start, end = -(-start // self.step), end // self.step
+                if end > start:
+                    yield start, end
+
+    def _day_minute_intervals(self, day):
+        if date.fromordinal(day).weekday() >= 5:
+            return
+        base = day * 1440
+        for seg_start, seg_end in self.day_segments:
+            start, end = base + seg_start, base + seg_end
+            k = bisect.bisect_right(self._unavailable_ends, start)
+            while start < end:
+                if k < len(self._unavailable_starts) and self._unavailable_starts[k] < end:
+                    if self._unavailable_starts[k] > start:
+                        yield start, self._unavailable_starts[k]
+                    start = max(start, self._unavailable_ends[k])
+                    k += 1
+                else:
+                    yield start, end
+                    break
+
+    def _compile(self, first_day, end_day):
+        self._first_day, self._end_day = first_day, end_day
+        self._starts, self._ends, self._cum_ends = [], [], []
+        self._append_days(first_day, end_day)
+
+    def _append_days(self, first_day, end_day):
+        total = self._cum_ends[-1] if self._cum_ends else 0
+        for day in range(first_day, end_day):
+            for start, end in self._day_intervals(day):
+                total += end - start
+                self._starts.append(start)
+                self._ends.append(end)
+                self._cum_ends.append(total)
+        self._end_day = end_day
+
+    def _cover(self, day):
+        """Compile au moins [day, day + 1 an)."""
+        if self._first_day is None or day < self._first_day:
+            self._compile(day, max(day + 366, self._end_day or 0))
+        elif day + 1 > self._end_day:
+            self._append_days(self._end_day, max(day + 1, self._end_day + 366))
+
+    def _locate(self, unit):
+        """Index de l'intervalle contenant `unit` ou du suivant (None si aucun travail)."""
+        if not self.day_segments:
+            return None
+        day = self._unit_day(unit)
+        limit_day = day + 8
+        if self._last_unavailable_day is not None:
+            limit_day = max(limit_day, self._last_unavailable_day + 8)
+        self._cover(day)
+        while True:
+            i = bisect.bisect_right(self._ends, unit)
+            if i < len(self._starts):
+                return i
+            if self._end_day > limit_day:
+                return None
+            self._cover(self._end_day)
+
+    def _working_offset(self, unit):
+        """Unités travaillées compilées avant `unit` (référence propre à la compilation)."""
+        i = self._locate(unit)
+        if i is None:
+            return self._cum_ends[-1] if self._cum_ends else 0
+        return self._cum_ends[i] - (self._ends[i] - max(unit, self._starts[i]))
+
+    @_synchronized
+    def working_units_between(self, start_unit, end_unit):
+        """Unités travaillées dans [start_unit, end_unit)."""
+        if end_unit <= start_unit:
+            return 0
+        self._cover(self._unit_day(start_unit))
+        return self._working_offset(end_unit) - self._working_offset(start_unit)
+
+    def working_minutes_between(self, start_dt, end_dt):
+        """Minutes travaillées (unités entières) dans [start_dt, end_dt)."""
+        return self.working_units_between(self.unit_index(start_dt), self.unit_index(end_dt)) * self.unit_minutes
+
+    @_synchronized
+    def is_working(self, dt_obj):
+        unit = self.unit_floor(dt_obj)
+        i = self._locate(unit)
+        return i is not None and self._starts[i] <= unit
+
+    @_synchronized
+    def next_working_unit(self, unit):
+        """Première unité travaillée >= unit (None si aucun travail)."""
+        i = self._locate(unit)
+        if i is None:
+            return None
+        return max(unit, self._starts[i])
+
+    @_synchronized
+    def add_working_units(self, unit, units):
+        """Frontière de fin d'un travail de `units` unités commencé à la première unité travaillée >= unit."""
+        i = self._locate(unit)
+        if i is None:
+            return None
+        start = max(unit, self._starts[i])
+        target = self._cum_ends[i] - (self._ends[i] - start) + units
+        while target > self._cum_ends[-1]:
+            self._cover(self._end_day)
+        j = bisect.bisect_left(self._cum_ends, target, lo=i)
+        return self._ends[j] - (self._cum_ends[j] - target)
+
+    @_synchronized
+    def prev_working_end(self, unit):
+        """Dernière frontière <= unit qui termine une unité travaillée (None si aucun travail)."""
+        if not self.day_segments:
+            return None
+        day = self._unit_day(unit)
+        limit_day = day - 8
+        if self._first_unavailable_day is not None:
+            limit_day = min(limit_day, self._first_unavailable_day - 8)
+        self._cover(day)
+        while True:
+            i = bisect.bisect_left(self._starts, unit) - 1
+            if i >= 0:
+                return min(unit, self._ends[i])
+            if self._first_day < limit_day:
+                return None
+            self._cover(self._first_day - 366)
+
+    @_synchronized
+    def sub_working_units(self, end_unit, units):
+        """Début au plus tard d'un travail de `units` unités fini à la frontière end_unit ou avant."""
+        end = self.prev_working_end(end_unit)
+        if end is None:
+            return None
+        while True:
+            i = bisect.bisect_left(self._starts, end) - 1
+            target = self._cum_ends[i] - (self._ends[i] - end) - units
+            if target >= 0:
+                break
+            # remonter d'un an ; la compilation repart de zéro, les cumuls sont recalculés
+            self._cover(self._first_day - 366)
+        j = bisect.bisect_right(self._cum_ends, target, hi=i + 1)
+        return self._ends[j] - (self._cum_ends[j] - target)
+
+    def next_working_datetime(self, dt_obj):
+        """Début de la première unité travaillée à partir de dt_obj (arrondi à l'unité supérieure)."""
+        unit = self.next_working_unit(self.unit_index(dt_obj))
+        return None if unit is None else self.unit_start(unit)
+
+    def add_working_minutes(self, dt_obj, minutes):
+        """Fin d'un travail de `minutes` minutes (arrondi à l'unité) commencé au plus tôt à dt_obj."""
+        units = self.duration_units(minutes)
+        end_unit = self.add_working_units(self.unit_index(dt_obj), units)
+        if end_unit is None:
+            return None
+        if units <= 0:
+            return self.next_working_datetime(dt_obj)
+        return self.unit_end(end_unit)
+
+class _LoadBuckets:
+    """Charge en minutes par index entier (jour ordinal, semaine), tableau extensible."""
+    def __init__(self):
+        self.base = None
+        self.values = []
+
+    def get(self, idx):
+        if self.base is None or not (0 <= idx - self.base < len(self.values)):
+            return 0
+        return self.values[idx - self.base]
+
+    def add(self, idx, minutes):
+        if self.base is None:
+            self.base = idx
+        if idx < self.base:
+            self.values[:0] = [0] * (self.base - idx)
+            self.base = idx
+        if idx - self.base >= len(self.values):
+            self.values.extend([0] * (idx - self.base + 1 - len(self.values)))
+        self.values[idx - self.base] += minutes
+
+def _week_index(day_ordinal):
+    # date(1, 1, 1), d'ordinal 1, est un lundi : semaines du lundi au dimanche
+    return (day_ordinal - 1) // 7
+
+class _GapNode:
+    __slots__ = ("key", "start", "end", "gap_start", "gap", "max_gap", "priority", "left", "right")
+
+    def __init__(self, key, start, end, priority):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.gap_start = None   # fin de la réservation précédente (None : aucune)
+        self.gap = 0            # unités travaillées dans [gap_start, start), -1 si chevauchement
+        self.max_gap = 0
+        self.priority = priority
+        self.left = None
+        self.right = None
+
+class _GapIndex:
+    """
+    Réservations d'un poste dans un treap ordonné par réservation (début, fin, clé).
+    Chaque nœud porte le créneau libre qui précède sa réservation, [gap_start, start)
+    en unités du calendrier, avec sa longueur en unités travaillées ; chaque sous-arbre
+    connaît son plus long créneau libre. Premier (dernier) créneau assez long,
+    réservation et libération en O(log n) attendu.
+    Débuts et fins sont croissants avec la clé : les réservations ne se chevauchent
+    pas et les arrondis d'unité (unit_floor, unit_index) sont monotones.
+    """
+    def __init__(self, working_cal):
+        self.calendar = working_cal
+        self.root = None
+        self._random = random.Random(0)
+
+    def __iter__(self):
+        stack, node = [], self.root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.key
+            node = node.right
+
+    def _gap_length(self, gap_start, start):
+        if gap_start is None:
+            return float("inf")
+        if gap_start > start:
+            return -1
+        return self.calendar.working_units_between(gap_start, start)
+
+    @staticmethod
+    def _update(node):
+        node.max_gap = node.gap
+        if node.left and node.left.max_gap > node.max_gap:
+            node.max_gap = node.left.max_gap
+        if node.right and node.right.max_gap > node.max_gap:
+            node.max_gap = node.right.max_gap
+
+    def _split(self, node, key, inclusive=False):
+        """(clés < key, clés >= key), ou (<=, >) si inclusive."""
+        if node is None:
+            return None, None
+        if node.key < key or (inclusive and node.key == key):
+            node.right, right = self._split(node.right, key, inclusive)
+            self._update(node)
+            return node, right
+        left, node.left = self._split(node.left, key, inclusive)
+        self._update(node)
+        return left, node
+
+    def _merge(self, left, right):
+        if left is None or right is None:
+            return left or right
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+
+    def _set_gap_start(self, node, key, gap_start):
+        if node.key == key:
+            node.gap_start = gap_start
+            node.gap = self._gap_length(gap_start, node.start)
+        elif key < node.key:
+            self._set_gap_start(node.left, key, gap_start)
+        else:
+            self._set_gap_start(node.right, key, gap_start)
+        self._update(node)
+
+    def _neighbours(self, key):
+        """Nœuds de la réservation précédente et de la suivante."""
+        pred = succ = None
+        node = self.root
+        while node:
+            if node.key < key:
+                pred, node = node, node.right
+            elif node.key > key:
+                succ, node = node, node.left
+            else:
+                if node.left:
+                    pred = node.left
+                    while pred.right:
+                        pred = pred.right
+                if node.right:
+                    succ = node.right
+                    while succ.left:
+                        succ = succ.left
+                break
+        return pred, succ
+
+    def insert(self, key, start, end):
+        pred, succ = self._neighbours(key)
+        node = _GapNode(key, start, end, self._random.random())
+        node.gap_start = pred.end if pred else None
+        node.gap = node.max_gap = self._gap_length(node.gap_start, start)
+        left, right = self._split(self.root, key)
+        self.root = self._merge(self._merge(left, node), right)
+        if succ:
+            self._set_gap_start(self.root, succ.key, end)
+
+    def remove(self, key):
+        pred, succ = self._neighbours(key)
+        left, right = self._split(self.root, key)
+        _, right = self._split(right, key, inclusive=True)
+        self.root = self._merge(left, right)
+        if succ:
+            self._set_gap_start(self.root, succ.key, pred.end if pred else None)
+
+    def _first_gap_after(self, node, key, units):
+        """Première réservation de clé > key précédée d'un créneau d'au moins `units` unités."""
+        if node is None or node.max_gap < units:
+            return None
+        if node.key > key:
+            found = self._first_gap_after(node.left, key, units)
+            if found:
+                return found
+            if node.gap >= units:
+                return node
+        return self._first_gap_after(node.right, key, units)
+
+    def _last_gap_until(self, node, key, units):
+        """Dernière réservation de clé <= key précédée d'un créneau d'au moins `units` unités."""
+        if node is None or node.max_gap < units:
+            return None
+        if node.key <= key:
+            found = self._last_gap_until(node.right, key, units)
+            if found:
+                return found
+            if node.gap >= units:
+                return node
+        return self._last_gap_until(node.left, key, units)
+
+    def first_fit(self, unit, units):
+        """Début au plus tôt >= unit d'un créneau libre de `units` unités travaillées."""
+        # première réservation qui finit après unit
+        blocking, node = None, self.root
+        while node:
+            if node.end > unit:
+                blocking, node = node, node.left
+            else:
+                node = node.right
+        if blocking is None:
+            last = self.root
+            while last and last.right:
+                last = last.right
+            return unit if last is None else max(unit, last.end)
+        start = unit if blocking.gap_start is None else max(unit, blocking.gap_start)
+        if start <= blocking.start and self.calendar.working_units_between(start, blocking.start) >= units:
+            return start
+        found = self._first_gap_after(self.root, blocking.key, units)
+        if found:
+            return found.gap_start
+        last = self.root
+        while last.right:
+            last = last.right
+        return last.end
+
+    def latest_fit(self, end_unit, units):
+        """Fin au plus tard <= end_unit d'un créneau libre de `units` unités travaillées."""
+        # dernière réservation qui commence avant end_unit
+        blocking, node = None, self.root
+        while node:
+            if node.start < end_unit:
+                blocking, node = node, node.right
+            else:
+                node = node.left
+        if blocking is None:
+            return end_unit
+        if blocking.end <= end_unit and self.calendar.working_units_between(blocking.end, end_unit) >= units:
+            return end_unit
+        # le premier nœud a un créneau infini : on trouve toujours
+        return self._last_gap_until(self.root, blocking.key, units).start
+
 class Post:
     def __init__(self, id, name, default_capacity_hours_week=35, 
                  work_start_time_config=time(8, 0), work_end_time_config=time(17, 0), 
-                 lunch_start_time_config=time(12,0), lunch_end_time_config=time(13,0)):
+                 lunch_start_time_config=time(12,0), lunch_end_time_config=time(13,0),
+                 time_granularity=SCHEDULING_GRANULARITY):
         self.id = id
         self.name = name
+        self.default_capacity_hours_week = default_capacity_hours_week
         
         self.work_start_time = work_start_time_config
         self.work_end_time = work_end_time_config
         self.lunch_start_time = lunch_start_time_config
         self.lunch_end_time = lunch_end_time_config
 
-        # Calculate effective work hours per day
-        ws = datetime.combine(date.min, self.work_start_time)
-        we = datetime.combine(date.min, self.work_end_time)
-        ls = datetime.combine(date.min, self.lunch_start_time)
-        le = datetime.combine(date.min, self.lunch_end_time)
+        self.shift = shift_template(self.work_start_time, self.work_end_time,
+                                    self.lunch_start_time, self.lunch_end_time)
+        self.daily_capacity_hours = self.shift.daily_capacity_hours
+
+        time_granularity_step(time_granularity)
+        self.time_granularity = time_granularity
 
-        self.daily_capacity_hours = 0
-        if we > ws:
-            total_work_seconds = (we - ws).total_seconds()
-            lunch_seconds = 0
-            # Check for a valid lunch break that is within work hours
-            if le > ls and ls >= ws and le <= we:
-                actual_lunch_start = max(ws, ls)
-                actual_lunch_end = min(we, le)
-                if actual_lunch_end > actual_lunch_start:
-                    lunch_seconds = (actual_lunch_end - actual_lunch_start).total_seconds()
-            
-            self.daily_capacity_hours = (total_work_seconds - lunch_seconds) / 3600.0
-            if self.daily_capacity_hours < 0: self.daily_capacity_hours = 0
-        
         self.unavailable_periods = []
-        self.scheduled_slots = []
+        # réservations (début, fin, clé opération) sans chevauchement, indexées en unités
+        # du calendrier avec les créneaux libres qui les séparent (gap_index)
+        self._gap_index = None
+        self._bookings = {}      # clé opération -> (réservation, [(jour ordinal, minutes)])
+        self.daily_load = _LoadBuckets()    # minutes réservées par jour ordinal
+        self.weekly_load = _LoadBuckets()   # minutes réservées par semaine (_week_index)
+        self._calendar = None
 
     def add_unavailable_period(self, start_date_str, end_date_str):
         try:
@@ -311,165 +1351,249 @@ class Post:
             if end_dt < start_dt:
                 print(f"Warning: Invalid unavailability period for post {self.id}: end date is before start date. {start_date_str} - {end_date_str}")
                 return
+            # tri et fusion une seule fois, à la compilation du calendrier
             self.unavailable_periods.append((start_dt, end_dt))
-            self.unavailable_periods.sort()
+            self._calendar = None
         except ValueError:
             print(f"Warning: Invalid date format for unavailability period for post {self.id}: {start_date_str}-{end_date_str}")
 
     def _is_working_moment(self, dt_obj):
-        if dt_obj.weekday() >= 5:
-            return False
-        
-        current_time = dt_obj.time()
-        if not (self.work_start_time <= current_time < self.work_end_time):
-            return False
-        
-        if self.lunch_start_time <= current_time < self.lunch_end_time:
-            return False
-        
-        for un_start, un_end in self.unavailable_periods:
-            if un_start <= dt_obj <= un_end:
-                return False
-        return True
+        return self.calendar.is_working(dt_obj)
 
     def _get_next_working_datetime(self, current_dt_orig):
-        current_dt = current_dt_orig
-        max_iterations = 10000
-        iterations = 0
-
-        while iterations < max_iterations:
-            iterations += 1
-            current_dt = current_dt.replace(second=0, microsecond=0)
-
-            while True:
-                date_changed = False
-                if current_dt.weekday() >= 5:
-                    current_dt = (current_dt + timedelta(days=1)).replace(hour=self.work_start_time.hour, minute=self.work_start_time.minute)
-                    date_changed = True
-                    continue
-
-                is_unavailable_day = False
-                for un_start, un_end in self.unavailable_periods:
-                    if un_start.date() <= current_dt.date() <= un_end.date():
-                        if current_dt < un_end:
-                             current_dt = (un_end + timedelta(minutes=1))
-                             current_dt = current_dt.replace(hour=self.work_start_time.hour, minute=self.work_start_time.minute)
-                             date_changed = True
-                             is_unavailable_day = True
-                             break
-                if is_unavailable_day:
-                    continue
-
-                break
-
-            current_time = current_dt.time()
-
-            if current_time >= self.work_end_time:
-                current_dt = (current_dt + timedelta(days=1)).replace(hour=self.work_start_time.hour, minute=self.work_start_time.minute)
-                continue
-
-            if current_time < self.work_start_time:
-                current_dt = current_dt.replace(hour=self.work_start_time.hour, minute=self.work_start_time.minute)
-
-            current_time = current_dt.time()
-
-            if self.lunch_start_time <= current_time < self.lunch_end_time:
-                current_dt = current_dt.replace(hour=self.lunch_end_time.hour, minute=self.lunch_end_time.minute)
-                continue
-
-            is_currently_unavailable = False
-            for un_start, un_end in self.unavailable_periods:
-                 if un_start <= current_dt < un_end:
-                      current_dt = un_end
-                      is_currently_unavailable = True
-                      break
-            if is_currently_unavailable:
-                 continue
-
-            if self._is_working_moment(current_dt):
-                return current_dt
-            
-            current_dt += timedelta(minutes=1)
-
-        print(f"Warning: Post {self.id} _get_next_working_datetime exceeded max iterations from {current_dt_orig}. Returning original.")
-        return current_dt_orig
+        next_dt = self.calendar.next_working_datetime(current_dt_orig)
+        if next_dt is None:
+            print(f"Warning: Post {self.id} has no working time after {current_dt_orig}. Returning original.")
+            return current_dt_orig
+        return next_dt
+
+    @property
+    def calendar(self):
+        if self._calendar is None:
+            self.unavailable_periods.sort()
+            self._calendar = working_calendar(self.shift, self.unavailable_periods, self.time_granularity)
+        return self._calendar
+
+    @property
+    def gap_index(self):
+        """Index des réservations, reconstruit si le calendrier a changé (arrondi englobant)."""
+        cal = self.calendar
+        if self._gap_index is None or self._gap_index.calendar is not cal:
+            self._gap_index = _GapIndex(cal)
+            for booking in sorted(booking for booking, _ in self._bookings.values()):
+                self._gap_index.insert(booking, cal.unit_floor(booking[0]), cal.unit_index(booking[1]))
+        return self._gap_index
+
+    @property
+    def scheduled_slots(self):
+        """Réservations (début, fin, clé opération) triées."""
+        return list(self.gap_index)
+
+    def set_time_granularity(self, time_granularity):
+        """Change l'unité du calendrier ; les réservations existantes sont réindexées (arrondi englobant)."""
+        time_granularity_step(time_granularity)
+        if time_granularity == self.time_granularity:
+            return
+        self.time_granularity = time_granularity
+        self._calendar = None
+
+    @staticmethod
+    def _duration_minutes(duration_hours):
+        # minutes de travail entamées (une minute entamée est consommée en entier)
+        remaining_seconds = duration_hours * 3600
+        minutes = int(remaining_seconds // 60)
+        if remaining_seconds - minutes * 60 > 0:
+            minutes += 1
+        return minutes
 
     def calculate_end_datetime(self, start_dt_param, duration_hours):
         if duration_hours <= 0:
             return start_dt_param
 
-        actual_start_dt = self._get_next_working_datetime(start_dt_param)
-        
-        current_dt = actual_start_dt
-        remaining_seconds = duration_hours * 3600
-        
-        max_calc_iterations = 20000
-        calc_iter = 0
-
-        while remaining_seconds > 0 and calc_iter < max_calc_iterations:
-            calc_iter += 1
-            if not self._is_working_moment(current_dt):
-                current_dt = self._get_next_working_datetime(current_dt)
-                if current_dt == self._get_next_working_datetime(current_dt + timedelta(microseconds=1)) and self._is_working_moment(current_dt) == False:
-                    print(f"Error: Post {self.id} calculate_end_datetime stuck finding next working moment from {current_dt}.")
-                    return datetime.max
-                continue
-
-            next_minute_dt = current_dt + timedelta(minutes=1)
-            
-            if self._is_working_moment(current_dt):
-                seconds_this_minute = 60
-                can_consume_seconds = min(remaining_seconds, seconds_this_minute)
-                remaining_seconds -= can_consume_seconds
-                current_dt = next_minute_dt
-            else:
-                current_dt = self._get_next_working_datetime(current_dt)
-
-        if remaining_seconds > 0:
-            print(f"Warning: Post {self.id} calculate_end_datetime could not schedule full duration. Remaining: {remaining_seconds/3600} hrs.")
+        end_dt = self.calendar.add_working_minutes(start_dt_param, self._duration_minutes(duration_hours))
+        if end_dt is None:
+            print(f"Error: Post {self.id} calculate_end_datetime: no working time available after {start_dt_param}.")
             return datetime.max
+        return end_dt
+
+    def _day_loads(self, start_dt, end_dt):
+        """Répartition d'un créneau en minutes travaillées par jour ordinal."""
+        loads = []
+        day = start_dt.toordinal()
+        while True:
+            day_start = max(start_dt, datetime.fromordinal(day))
+            day_end = min(end_dt, datetime.fromordinal(day + 1))
+            if day_start >= end_dt:
+                break
+            minutes = self.calendar.working_minutes_between(day_start, day_end)
+            if minutes:
+                loads.append((day, minutes))
+            day += 1
+        return loads
+
+    def _weekly_room(self, week):
+        """Minutes encore réservables la semaine `week` sous DefaultCapacityHoursWeek (None : pas de plafond)."""
+        if not self.default_capacity_hours_week or self.default_capacity_hours_week <= 0:
+            return None
+        return self.default_capacity_hours_week * 60 - self.weekly_load.get(week)
+
+    def overflow_weeks(self, start_dt, end_dt):
+        """Semaines, triées, où le créneau dépasserait DefaultCapacityHoursWeek."""
+        if self._weekly_room(0) is None:
+            return []
+        added = defaultdict(int)
+        for day, minutes in self._day_loads(start_dt, end_dt):
+            added[_week_index(day)] += minutes
+        return [week for week in sorted(added) if added[week] > self._weekly_room(week)]
+
+    def weekly_overflow(self, start_dt, end_dt):
+        """Première semaine où le créneau dépasserait DefaultCapacityHoursWeek (None si aucune)."""
+        weeks = self.overflow_weeks(start_dt, end_dt)
+        return weeks[0] if weeks else None
+
+    def fits_weekly_capacity(self, start_dt, end_dt):
+        """Vrai si le créneau tient dans DefaultCapacityHoursWeek pour chaque semaine touchée."""
+        return self.weekly_overflow(start_dt, end_dt) is None
+
+    def load_hours(self, day):
+        """Charge réservée (heures) le jour `day` et sur sa semaine."""
+        ordinal = day.toordinal()
+        return self.daily_load.get(ordinal) / 60.0, self.weekly_load.get(_week_index(ordinal)) / 60.0
+
+    @contextlib.contextmanager
+    def _ignoring_booking(self, of_id):
+        """Retire la réservation de of_id de l'index des créneaux libres le temps d'une recherche."""
+        entry = self._bookings.get(of_id) if of_id else None
+        if entry is None:
+            yield
+            return
+        booking = entry[0]
+        gap_index = self.gap_index
+        gap_index.remove(booking)
+        try:
+            yield
+        finally:
+            gap_index.insert(booking, gap_index.calendar.unit_floor(booking[0]), gap_index.calendar.unit_index(booking[1]))
+
+    def find_available_slot(self, search_start_dt_param, duration_hours, of_id_to_ignore=None, respect_weekly_capacity=False):
+        # recherche en unités entières du calendrier (voir time_granularity)
+        cal = self.calendar
+        units = cal.duration_units(self._duration_minutes(duration_hours)) if duration_hours > 0 else 0
+        current_try_unit = cal.next_working_unit(cal.unit_index(search_start_dt_param))
+        max_search_unit = cal.unit_index(search_start_dt_param + timedelta(days=180))
+
+        with self._ignoring_booking(of_id_to_ignore):
+            while current_try_unit is not None and current_try_unit < max_search_unit:
+                # premier créneau libre assez long à partir du début candidat
+                free_unit = self.gap_index.first_fit(current_try_unit, units)
+                if free_unit != current_try_unit:
+                    current_try_unit = cal.next_working_unit(free_unit)
+                    continue
+                potential_end_unit = cal.add_working_units(current_try_unit, units)
+
+                current_try_start_dt = cal.unit_start(current_try_unit)
+                potential_end_dt = cal.unit_end(potential_end_unit) if units else current_try_start_dt
+
+                # capacité hebdomadaire dépassée ; les débuts intermédiaires dépasseraient aussi :
+                # - semaine de début : retarder le début jusqu'à ce que sa part tienne dans le
+                #   reste de la semaine, la semaine suivante seulement si elle est pleine ;
+                # - semaine suivante : sa part ne fait que croître tant que l'opération commence
+                #   avant elle, commencer dans cette semaine
+                overflow_week = self.weekly_overflow(current_try_start_dt, potential_end_dt) if respect_weekly_capacity else None
+                if overflow_week is not None:
+                    if overflow_week == _week_index(current_try_start_dt.toordinal()):
+                        week_end_unit = cal.unit_index(datetime.fromordinal((overflow_week + 1) * 7 + 1))
+                        room_units = self._weekly_room(overflow_week) // cal.unit_minutes
+                        next_start_unit = cal.sub_working_units(week_end_unit, room_units) if room_units > 0 else None
+                        if next_start_unit is None or next_start_unit <= current_try_unit:
+                            next_start_unit = week_end_unit
+                    else:
+                        next_start_unit = cal.unit_index(datetime.fromordinal(overflow_week * 7 + 1))
+                    current_try_unit = cal.next_working_unit(next_start_unit)
+                    continue
 
-        return current_dt
-
-    def find_available_slot(self, search_start_dt_param, duration_hours, of_id_to_ignore=None):
-        current_try_start_dt = self._get_next_working_datetime(search_start_dt_param)
-        
-        max_search_datetime = search_start_dt_param + timedelta(days=180)
-
-        while current_try_start_dt < max_search_datetime:
-            potential_end_dt = self.calculate_end_datetime(current_try_start_dt, duration_hours)
+                return current_try_start_dt, potential_end_dt
 
-            if potential_end_dt == datetime.max:
-                current_try_start_dt = (current_try_start_dt + timedelta(days=1)).replace(
-                    hour=self.work_start_time.hour, minute=self.work_start_time.minute)
-                current_try_start_dt = self._get_next_working_datetime(current_try_start_dt)
-                continue
+        if respect_weekly_capacity and self._weekly_room(0) is not None:
+            print(f"Warning: Slot search for post {self.id} found no slot within {self.default_capacity_hours_week}h/week from {search_start_dt_param} for {duration_hours}hr task.")
+        else:
+            print(f"Warning: Slot search for post {self.id} exceeded search limit from {search_start_dt_param} for {duration_hours}hr task.")
+        return None, None
+    
+    def find_latest_slot(self, latest_end_dt, duration_hours, earliest_start_dt, of_id_to_ignore=None, respect_weekly_capacity=False):
+        """
+        Créneau libre le plus tardif qui se termine au plus tard à latest_end_dt et commence
+        au plus tôt à earliest_start_dt (symétrique de find_available_slot). Retourne
+        (début, fin) ou (None, None).
+        """
+        cal = self.calendar
+        units = cal.duration_units(self._duration_minutes(duration_hours)) if duration_hours > 0 else 0
+        min_start_unit = cal.unit_index(earliest_start_dt)
+        current_end_unit = cal.prev_working_end(cal.end_unit_index(latest_end_dt))
+
+        with self._ignoring_booking(of_id_to_ignore):
+            while current_end_unit is not None:
+                # dernier créneau libre assez long qui finit à la fin candidate ou avant
+                free_end_unit = self.gap_index.latest_fit(current_end_unit, units)
+                if free_end_unit != current_end_unit:
+                    current_end_unit = cal.prev_working_end(free_end_unit)
+                    continue
+                potential_start_unit = cal.sub_working_units(current_end_unit, units) if units else current_end_unit
+                if potential_start_unit is None or potential_start_unit < min_start_unit:
+                    break
 
-            is_overlap = False
-            for booked_start, booked_end, booked_of_id in self.scheduled_slots:
-                if of_id_to_ignore and booked_of_id == of_id_to_ignore:
+                potential_end_dt = cal.unit_end(current_end_unit)
+                current_try_start_dt = cal.unit_start(potential_start_unit) if units else potential_end_dt
+
+                # capacité hebdomadaire dépassée (symétrique de find_available_slot) :
+                # - semaine de fin : avancer la fin jusqu'à ce que sa part tienne dans le reste
+                #   de la semaine, la semaine précédente seulement si elle est pleine ;
+                # - semaine précédente : finir dans la dernière semaine dépassée
+                overflow_weeks = self.overflow_weeks(current_try_start_dt, potential_end_dt) if respect_weekly_capacity else []
+                if overflow_weeks:
+                    overflow_week = overflow_weeks[-1]
+                    if overflow_week == _week_index((potential_end_dt - timedelta(microseconds=1)).toordinal()):
+                        week_start_unit = cal.end_unit_index(datetime.fromordinal(overflow_week * 7 + 1))
+                        room_units = self._weekly_room(overflow_week) // cal.unit_minutes
+                        next_end_unit = cal.add_working_units(week_start_unit, room_units) if room_units > 0 else None
+                        if next_end_unit is None or next_end_unit >= current_end_unit:
+                            next_end_unit = week_start_unit
+                    else:
+                        next_end_unit = cal.end_unit_index(datetime.fromordinal((overflow_week + 1) * 7 + 1))
+                    current_end_unit = cal.prev_working_end(next_end_unit)
                     continue
-                if current_try_start_dt < booked_end and potential_end_dt > booked_start:
-                    is_overlap = True
-                    current_try_start_dt = self._get_next_working_datetime(booked_end)
-                    break 
-            
-            if not is_overlap:
+
                 return current_try_start_dt, potential_end_dt
 
-        print(f"Warning: Slot search for post {self.id} exceeded search limit from {search_start_dt_param} for {duration_hours}hr task.")
         return None, None
-    
+
     def book_slot(self, start_dt, end_dt, of_id):
         self.clear_schedule_for_of(of_id)
-        self.scheduled_slots.append((start_dt, end_dt, of_id))
-        self.scheduled_slots.sort()
+        booking = (start_dt, end_dt, of_id)
+        self.gap_index.insert(booking, self.calendar.unit_floor(start_dt), self.calendar.unit_index(end_dt))
+        day_loads = self._day_loads(start_dt, end_dt)
+        for day, minutes in day_loads:
+            self.daily_load.add(day, minutes)
+            self.weekly_load.add(_week_index(day), minutes)
+        self._bookings[of_id] = (booking, day_loads)
 
     def clear_schedule_for_of(self, of_id):
-        self.scheduled_slots = [(s, e, o) for s, e, o in self.scheduled_slots if o != of_id]
+        entry = self._bookings.pop(of_id, None)
+        if entry is None:
+            return
+        booking, day_loads = entry
+        self.gap_index.remove(booking)
+        for day, minutes in day_loads:
+            self.daily_load.add(day, -minutes)
+            self.weekly_load.add(_week_index(day), -minutes)
+
+    def clear_schedule(self):
+        """Libère toutes les réservations du poste."""
+        for of_id in list(self._bookings):
+            self.clear_schedule_for_of(of_id)
 
     def __repr__(self):
-        return f"Post(id={self.id}, name='{self.name}', daily_hours={self.daily_capacity_hours:.2f}, unavailable_periods={len(self.unavailable_periods)}, scheduled_slots={len(self.scheduled_slots)})"
+        return f"Post(id={self.id}, name='{self.name}', daily_hours={self.daily_capacity_hours:.2f}, unavailable_periods={len(self.unavailable_periods)}, scheduled_slots={len(self._bookings)})"
 
 class Operation:
     def __init__(self, product_key, operation_name, post_id, standard_time_hours, sequence, priority):
@@ -480,6 +1604,59 @@ class Operation:
         self.sequence = sequence
         self.priority = priority
 
+# étape de gamme compilée : opération, Post résolu (None si inconnu), suffixe de la clé
+# de réservation (clé = of.id + key_suffix)
+RoutingStep = namedtuple("RoutingStep", ["operation", "post", "key_suffix"])
+
+class RoutingTable(Mapping):
+    """
+    Gammes compilées, en lecture seule : clé produit (ProductID ou ProductType) -> tuple
+    d'opérations triées par séquence. routing(product_id, product_type) retourne les
+    étapes avec Post résolu et repli sur le type de produit déjà appliqué, mémorisées par
+    couple : la préparation d'un OF est une seule recherche de dictionnaire. Les Post
+    résolus sont ceux de posts_map (voir for_posts pour une autre copie des postes).
+    """
+    def __init__(self, operations_by_product, posts_map):
+        self._operations = {
+            key: tuple(sorted(ops, key=lambda op: op.sequence))
+            for key, ops in operations_by_product.items() if ops
+        }
+        self.posts_map = posts_map
+        self._steps = {
+            key: tuple(RoutingStep(op, posts_map.get(op.post_id), "_" + op.operation_name) for op in ops)
+            for key, ops in self._operations.items()
+        }
+        self._routings = {}
+
+    def __getitem__(self, key):
+        return self._operations[key]
+
+    def __iter__(self):
+        return iter(self._operations)
+
+    def __len__(self):
+        return len(self._operations)
+
+    def routing(self, product_id, product_type):
+        key = (product_id, product_type)
+        steps = self._routings.get(key)
+        if steps is None:
+            steps = self._steps.get(product_id) or self._steps.get(product_type, ())
+            self._routings[key] = steps
+        return steps
+
+    def for_posts(self, posts_map):
+        """La même table, résolue sur posts_map (copie des postes, instantané rechargé...)."""
+        if posts_map is self.posts_map:
+            return self
+        return RoutingTable(self._operations, posts_map)
+
+def as_routing_table(operations_map, posts_map):
+    """Accepte une RoutingTable ou un dict produit -> [Operation] ; retourne la table résolue sur posts_map."""
+    if isinstance(operations_map, RoutingTable):
+        return operations_map.for_posts(posts_map)
+    return RoutingTable(operations_map, posts_map)
+
 # --- Helper Functions ---
 def detect_csv_delimiter(filepath, fallback=','):
     """
@@ -503,80 +1680,404 @@ def detect_csv_delimiter(filepath, fallback=','):
     return fallback
 
 def find_qty_of_component_in_product(product_to_make_id, component_to_find_id, bom_data, memo=None):
-    if memo is None: memo = {}
-    if (product_to_make_id, component_to_find_id) in memo:
-        return memo[(product_to_make_id, component_to_find_id)]
+    """
+    Compatibilité : délègue au BOMGraph. Passer un BOMGraph déjà construit évite de
+    recompiler la nomenclature à chaque appel (`memo` n'est plus utilisé).
+    """
+    return as_bom_graph(bom_data).qty_of_component(product_to_make_id, component_to_find_id)
 
-    if product_to_make_id == component_to_find_id: return 1.0
+def sort_ofs_for_grouping(of_list):
+    return sorted(of_list, key=lambda of: (of.designation, -of.bom_level, of.need_date))
 
-    total_component_needed = 0.0
-    direct_components = [b for b in bom_data if b.parent_product_id == product_to_make_id]
+class _FenwickFlags:
+    """Arbre de Fenwick sur des drapeaux 0/1 : bascule, comptage et recherche en O(log n)."""
+    def __init__(self, flags):
+        self.n = len(flags)
+        self.flags = [bool(flag) for flag in flags]
+        self.count = sum(self.flags)
+        self.tree = [0] + [int(flag) for flag in self.flags]
+        for i in range(1, self.n + 1):
+            parent = i + (i & -i)
+            if parent <= self.n:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, idx, flag):
+        if self.flags[idx] == flag:
+            return
+        self.flags[idx] = flag
+        delta = 1 if flag else -1
+        self.count += delta
+        i = idx + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, idx):
+        """Nombre de drapeaux levés sur [0, idx)."""
+        total = 0
+        while idx > 0:
+            total += self.tree[idx]
+            idx -= idx & -idx
+        return total
+
+    def kth(self, k):
+        """Index du k-ième drapeau levé (k >= 1)."""
+        pos = 0
+        step = 1 << self.n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+    def first_at_or_after(self, idx):
+        k = self.prefix(idx) + 1
+        return self.kth(k) if k <= self.count else None
+
+    def last_before(self, idx):
+        k = self.prefix(idx)
+        return self.kth(k) if k > 0 else None
+
+OF_FLAG_ASSIGNED = 1
+OF_FLAG_NON_GROUPABLE = 2
+
+class OFDateIndex:
+    """
+    Index des OFs triés par (need_date, ordre du fichier) :
+    - par produit normalisé, avec un arbre de Fenwick des OFs non affectés : les requêtes
+      « OF non affecté le plus proche de D » et « OFs non affectés dans [début, fin] »
+      coûtent O(log n) (+ k pour les plages) ;
+    - globalement, avec un bitmap de drapeaux (affecté / non groupable) : une fenêtre
+      de dates se résout par bisect puis parcours des seuls OFs de la fenêtre.
+    Les changements d'état doivent être signalés via mark_assigned / mark_unassigned /
+    mark_non_groupable. Les OFs sont repérés par identité d'objet : un Order Code en
+    double dans le fichier désigne deux OFs distincts.
+    """
+    def __init__(self, ofs):
+        per_product = defaultdict(list)
+        all_rows = []
+        for position, of in enumerate(ofs):
+            per_product[of.product_key].append((of.need_date, position, of))
+            all_rows.append((of.need_date, position, of))
+        all_rows.sort(key=lambda row: (row[0], row[1]))
+        self._window_dates = [row[0] for row in all_rows]
+        self._window_ofs = [row[2] for row in all_rows]
+        self._window_slot = {id(row[2]): idx for idx, row in enumerate(all_rows)}
+        self._code_slots = defaultdict(list)   # Order Code -> positions (non groupable par code)
+        for idx, row in enumerate(all_rows):
+            self._code_slots[row[2].id].append(idx)
+        self._flags = bytearray(
+            OF_FLAG_ASSIGNED if row[2].assigned_group_id is not None else 0 for row in all_rows
+        )
+        self._ofs = {}
+        self._dates = {}
+        self._positions = {}
+        self._free = {}
+        self._slot = {}
+        for prod, rows in per_product.items():
+            rows.sort(key=lambda row: (row[0], row[1]))
+            self._dates[prod] = [row[0] for row in rows]
+            self._positions[prod] = [row[1] for row in rows]
+            self._ofs[prod] = [row[2] for row in rows]
+            self._free[prod] = _FenwickFlags([row[2].assigned_group_id is None for row in rows])
+            for idx, row in enumerate(rows):
+                self._slot[id(row[2])] = (prod, idx)
+
+    def mark_assigned(self, of):
+        prod, idx = self._slot[id(of)]
+        self._free[prod].set(idx, False)
+        self._flags[self._window_slot[id(of)]] |= OF_FLAG_ASSIGNED
+
+    def mark_unassigned(self, of):
+        prod, idx = self._slot[id(of)]
+        self._free[prod].set(idx, True)
+        self._flags[self._window_slot[id(of)]] &= ~OF_FLAG_ASSIGNED
+
+    def mark_non_groupable(self, of):
+        # comme l'ancien ensemble d'Order Codes : tous les OFs du même code
+        for idx in self._code_slots[of.id]:
+            self._flags[idx] |= OF_FLAG_NON_GROUPABLE
+
+    def is_non_groupable(self, of):
+        return bool(self._flags[self._window_slot[id(of)]] & OF_FLAG_NON_GROUPABLE)
+
+    def unassigned_in_window(self, start_date, end_date):
+        """OFs non affectés (tous produits) avec start_date <= need_date <= end_date, triés par date."""
+        dates = self._window_dates
+        flags = self._flags
+        ofs = self._window_ofs
+        return [
+            ofs[idx]
+            for idx in range(bisect.bisect_left(dates, start_date), bisect.bisect_right(dates, end_date))
+            if not flags[idx] & OF_FLAG_ASSIGNED
+        ]
 
-    for bom_line in direct_components:
-        qty_in_child = find_qty_of_component_in_product(bom_line.child_product_id, component_to_find_id, bom_data, memo)
-        total_component_needed += bom_line.quantity_child_per_parent * qty_in_child
-            
-    memo[(product_to_make_id, component_to_find_id)] = total_component_needed
-    return total_component_needed
+    def earliest_unassigned(self, product_id):
+        """OF non affecté à la date la plus tôt (le premier du fichier en cas d'égalité)."""
+        free = self._free.get(product_id)
+        if free is None:
+            return None
+        idx = free.first_at_or_after(0)
+        return None if idx is None else self._ofs[product_id][idx]
 
-def sort_ofs_for_grouping(of_list):
-    return sorted(of_list, key=lambda of: (of.designation, -of.bom_level, of.need_date))
+    def nearest_unassigned(self, product_id, target_date):
+        """
+        OF non affecté dont l'écart en jours à target_date est minimal ; à écart égal,
+        le premier dans l'ordre du fichier (comme min() sur la liste d'origine).
+        """
+        free = self._free.get(product_id)
+        if free is None:
+            return None
+        dates = self._dates[product_id]
+        split = bisect.bisect_left(dates, target_date)
+        right = free.first_at_or_after(split)
+        left = free.last_before(split)
+        if left is not None:
+            # premier OF libre (ordre du fichier) à cette même date
+            left = free.first_at_or_after(bisect.bisect_left(dates, dates[left]))
+        if left is None and right is None:
+            return None
+        if left is None or right is None:
+            best = right if left is None else left
+        else:
+            diff_left = abs((dates[left] - target_date).days)
+            diff_right = abs((dates[right] - target_date).days)
+            if diff_left != diff_right:
+                best = left if diff_left < diff_right else right
+            else:
+                positions = self._positions[product_id]
+                best = left if positions[left] < positions[right] else right
+        return self._ofs[product_id][best]
+
+    def unassigned_in_range(self, product_id, start_date, end_date):
+        """OFs non affectés avec start_date <= need_date <= end_date, dans l'ordre du fichier."""
+        free = self._free.get(product_id)
+        if free is None:
+            return []
+        dates = self._dates[product_id]
+        stop = bisect.bisect_right(dates, end_date)
+        idx = free.first_at_or_after(bisect.bisect_left(dates, start_date))
+        found = []
+        while idx is not None and idx < stop:
+            found.append(idx)
+            idx = free.first_at_or_after(idx + 1)
+        positions = self._positions[product_id]
+        ofs = self._ofs[product_id]
+        return [ofs[i] for i in sorted(found, key=positions.__getitem__)]
 
 # --- Main Grouping Algorithm ---
-def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param):
-    group_counter = 1
-    groups = []
-    non_groupable_ids = set()
+class _FenwickSums:
+    """Arbre de Fenwick sur des quantités : mise à jour ponctuelle et somme de préfixe en O(log n)."""
+    def __init__(self, n):
+        self.n = n
+        self.tree = [0.0] * (n + 1)
+
+    def add(self, idx, delta):
+        i = idx + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, idx):
+        """Somme des quantités sur [0, idx)."""
+        total = 0.0
+        while idx > 0:
+            total += self.tree[idx]
+            idx -= idx & -idx
+        return total
+
+class InventoryLedger:
+    """
+    Stock usine partagé par tous les groupes. Chaque OF porte au plus un lot de son
+    produit, disponible à sa date de besoin ; les lots d'un produit sont rangés par
+    (date, ordre du fichier). Quantité disponible à une date (somme de Fenwick),
+    lot le plus ancien non vide (drapeaux de Fenwick), dépôt et prélèvement en O(log n).
+    """
+    EPS = 1e-9
+
+    def __init__(self, all_ofs):
+        per_product = defaultdict(list)
+        for position, of in enumerate(all_ofs):
+            per_product[of.product_key].append((of.need_date, position, of))
+        self._dates = {}
+        self._ofs = {}
+        self._remaining = {}
+        self._sums = {}
+        self._non_empty = {}
+        self._slot = {}
+        for prod, rows in per_product.items():
+            rows.sort(key=lambda row: (row[0], row[1]))
+            self._dates[prod] = [row[0] for row in rows]
+            self._ofs[prod] = [row[2] for row in rows]
+            self._remaining[prod] = [0.0] * len(rows)
+            self._sums[prod] = _FenwickSums(len(rows))
+            self._non_empty[prod] = _FenwickFlags([False] * len(rows))
+            for idx, row in enumerate(rows):
+                self._slot[id(row[2])] = (prod, idx)
+
+    def deposit(self, of, qty):
+        """Reverse qty de stock de l'OF dans le registre."""
+        prod, idx = self._slot[id(of)]
+        self._remaining[prod][idx] += qty
+        self._sums[prod].add(idx, qty)
+        self._non_empty[prod].set(idx, self._remaining[prod][idx] > self.EPS)
+
+    def available(self, product_id, by_date):
+        """Quantité en stock pour un produit (normalisé), lots disponibles au plus tard à by_date."""
+        dates = self._dates.get(product_id)
+        if not dates:
+            return 0.0
+        return max(0.0, self._sums[product_id].prefix(bisect.bisect_right(dates, by_date)))
+
+    def on_hand(self, product_id):
+        dates = self._dates.get(product_id)
+        return self.available(product_id, dates[-1]) if dates else 0.0
+
+    def draw(self, product_id, qty, by_date):
+        """
+        Prélève jusqu'à qty sur les lots disponibles à by_date, du plus ancien au plus
+        récent. Retourne [(OF fournisseur, quantité prise)].
+        """
+        dates = self._dates.get(product_id)
+        if not dates:
+            return []
+        limit = bisect.bisect_right(dates, by_date)
+        remaining = self._remaining[product_id]
+        sums = self._sums[product_id]
+        non_empty = self._non_empty[product_id]
+        drawn = []
+        while qty > self.EPS:
+            idx = non_empty.first_at_or_after(0)
+            if idx is None or idx >= limit:
+                break
+            take = min(remaining[idx], qty)
+            remaining[idx] -= take
+            qty -= take
+            if remaining[idx] <= self.EPS:
+                take += remaining[idx]
+                remaining[idx] = 0.0
+                non_empty.set(idx, False)
+            sums.add(idx, -take)
+            drawn.append((self._ofs[product_id][idx], take))
+        return drawn
+
+def net_inventory_across_groups(groups, all_ofs, bom_data):
+    """
+    Recalcule la consommation de tous les groupes en un passage, par début de fenêtre,
+    à travers un InventoryLedger commun : le surplus d'un groupe (premix, SF...) sert
+    les groupes suivants au lieu d'être ignoré. À appeler en dernier : un
+    calculate_consumption ultérieur sans registre revient au calcul par groupe.
+    Retourne le registre (stock restant en fin de plan).
+    """
+    bom_graph = as_bom_graph(bom_data)
+    ledger = InventoryLedger(all_ofs)
+    print(f"[CONSUMP] Netting usine sur {len(groups)} groupes.")
+    for group in sorted(groups, key=lambda g: g.time_window_start):
+        group.calculate_consumption(bom_graph, ledger=ledger)
+    # des lots ont pu être pris à des groupes déjà calculés : agrégats depuis les OFs
+    for group in groups:
+        individual_product_stocks = {}
+        for of in group.ofs:
+            pid = of.product_key
+            individual_product_stocks[pid] = individual_product_stocks.get(pid, 0) + of.individual_product_stock
+        group.individual_product_stocks = individual_product_stocks
+    return ledger
+
+def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param, parallel_workers=None):
+    """
+    Regroupe les OFs autour de leurs premix. Avec parallel_workers > 1, les familles
+    de nomenclature indépendantes sont groupées dans des processus séparés ; la
+    numérotation GRP<n> reste identique à l'exécution séquentielle.
+    """
+    bom_graph = as_bom_graph(bom_data)
 
-    # --- utils de normalisation ---
-    def norm(x):
-        return ''.join(str(x).split()).upper()
+    if parallel_workers and parallel_workers > 1:
+        groups = _run_grouping_parallel(all_ofs, bom_graph, horizon_H_weeks_param, parallel_workers)
+    else:
+        groups = [group for _, group in _group_ofs(all_ofs, bom_graph, horizon_H_weeks_param)]
+
+    # rapport final
+    unassigned_ofs_final = [of for of in all_ofs if of.assigned_group_id is None]
+    if unassigned_ofs_final:
+        print("\nWarning: Some OFs remain unassigned after grouping:")
+        for of in unassigned_ofs_final:
+            print(f"  - {of}")
+
+    return groups, all_ofs
+
+def _group_ofs(all_ofs, bom_graph, horizon_H_weeks_param, group_id_prefix="GRP"):
+    """Retourne [(OF client de base, groupe)] dans l'ordre de création des groupes."""
+    return list(_iter_group_ofs(all_ofs, bom_graph, horizon_H_weeks_param, group_id_prefix))
+
+def _iter_group_ofs(all_ofs, bom_graph, horizon_H_weeks_param, group_id_prefix="GRP"):
+    """
+    Boucle de groupement proprement dite. Génère (OF client de base, groupe) dès que
+    le groupe passe le contrôle final (étape 9) : ses OFs ne changent plus ensuite.
+    """
+    group_counter = 1
 
     # 0) set des vrais premix (les feuilles)
-    real_premix_ids = {
-        norm(b.child_product_id)
-        for b in bom_data
-        if int(b.child_bom_level) == 0
-    }
+    real_premix_ids = bom_graph.declared_premix_ids
 
     # 0bis) map inverse : child -> parents 
-    child_to_parents = {}
-    for b in bom_data:
-        c = norm(b.child_product_id)
-        p = norm(b.parent_product_id)
-        child_to_parents.setdefault(c, set()).add(p)
+    child_to_parents = bom_graph.parents
+
+    # 0ter) besoins composants de tous les OF clients, explosés en un seul lot
+    client_ofs = [of for of in all_ofs if of.product_type in ["PF", "SF"]]
+    client_requirements = dict(zip(map(id, client_ofs), bom_graph.batch_requirements(client_ofs)))
+
+    # 0ter bis) index inversé : composant -> produits clients qui le consomment (tous niveaux)
+    consumers_of = defaultdict(set)
+    for client_prod in {of.product_key for of in all_ofs if of.product_type in ["PF", "SF"]}:
+        for comp_id, _ in bom_graph.unit_requirements(client_prod):
+            consumers_of[comp_id].add(client_prod)
+
+    # 0quater) index des OFs triés par date, par produit et global (fenêtres + bitmap d'état)
+    of_index = OFDateIndex(all_ofs)
+
+    def assign(group, of, ps_quantity_change=0):
+        group.add_of(of, ps_quantity_change=ps_quantity_change)
+        of_index.mark_assigned(of)
+
+    # 0quinquies) file de priorité des OF clients (PF/SF) : (-niveau, date, désignation, rang fichier).
+    # Un OF affecté ou non groupable ne redevient jamais candidat : suppression paresseuse.
+    client_heap = [
+        (-of.bom_level, of.need_date, of.designation, position, of)
+        for position, of in enumerate(all_ofs)
+        if of.product_type in ["PF", "SF"]
+    ]
+    heapq.heapify(client_heap)
 
     while True:
         # 1) OF client de départ
-        unassigned_client_ofs = sorted(
-            [
-                of for of in all_ofs
-                if of.product_type in ["PF", "SF"]
-                and of.assigned_group_id is None
-                and of.id not in non_groupable_ids
-            ],
-            key=lambda of: (-of.bom_level, of.need_date, of.designation)
-        )
-        if not unassigned_client_ofs:
+        while client_heap and (
+            client_heap[0][-1].assigned_group_id is not None
+            or of_index.is_non_groupable(client_heap[0][-1])
+        ):
+            heapq.heappop(client_heap)
+        if not client_heap:
             break
 
-        base_client_of = unassigned_client_ofs[0]
+        base_client_of = client_heap[0][-1]
 
         # 2) calcul besoins descendant
-        needed_components = {}
-        family_product_ids = {norm(base_client_of.product_id)}
-
-        for bom_entry in bom_data:
-            qty_needed = find_qty_of_component_in_product(
-                base_client_of.product_id,
-                bom_entry.child_product_id,
-                bom_data
-            )
-            if qty_needed > 0:
-                child_norm = norm(bom_entry.child_product_id)
-                total_qty_needed = qty_needed * base_client_of.quantity
-                needed_components[child_norm] = needed_components.get(child_norm, 0.0) + total_qty_needed
-                family_product_ids.add(child_norm)
+        needed_components = dict(client_requirements[id(base_client_of)])
+
+        # famille du groupe, et produits clients qui en font partie ou en consomment un membre
+        family_product_ids = set()
+        family_clients = set()
+
+        def extend_family(product_ids):
+            for pid in product_ids:
+                if pid not in family_product_ids:
+                    family_product_ids.add(pid)
+                    family_clients.add(pid)
+                    family_clients.update(consumers_of.get(pid, ()))
+
+        extend_family((base_client_of.product_key,))
+        extend_family(needed_components.keys())
 
         # 3) trouver un vrai premix dispo pour ce client
         best_supply_candidate = None
@@ -585,16 +2086,8 @@ def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param):
         for comp_id_norm in needed_components.keys():
             if comp_id_norm not in real_premix_ids:
                 continue
-            candidate_supply = [
-                of for of in all_ofs
-                if of.assigned_group_id is None
-                and norm(of.product_id) == comp_id_norm
-            ]
-            if candidate_supply:
-                closest_supply = min(
-                    candidate_supply,
-                    key=lambda x: abs((x.need_date - base_client_of.need_date).days)
-                )
+            closest_supply = of_index.nearest_unassigned(comp_id_norm, base_client_of.need_date)
+            if closest_supply:
                 date_diff = abs((closest_supply.need_date - base_client_of.need_date).days)
                 if date_diff < best_date_diff:
                     best_date_diff = date_diff
@@ -602,24 +2095,19 @@ def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param):
 
         # pas de premix => pas de groupe
         if not best_supply_candidate:
-            non_groupable_ids.add(base_client_of.id)
+            of_index.mark_non_groupable(base_client_of)
             base_client_of.status = "UNASSIGNED"
             print(f"[GROUPING] OF {base_client_of.id} ignoré : aucun vrai premix dispo.")
             continue
 
-        main_premix = norm(best_supply_candidate.product_id)
+        main_premix = best_supply_candidate.product_key
         reference_date = best_supply_candidate.need_date
 
         # 4) fenêtre
         child_dates = []
         for comp_id_norm in needed_components.keys():
-            candidate_children = [
-                of for of in all_ofs
-                if of.assigned_group_id is None
-                and norm(of.product_id) == comp_id_norm
-            ]
-            if candidate_children:
-                earliest_child = min(candidate_children, key=lambda x: x.need_date)
+            earliest_child = of_index.earliest_unassigned(comp_id_norm)
+            if earliest_child:
                 child_dates.append(earliest_child.need_date)
 
         if child_dates:
@@ -634,19 +2122,20 @@ def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param):
         if not (window_start_date <= base_client_of.need_date <= window_end_date):
             # on marque cet OF comme non groupable dans ce run
             base_client_of.status = "UNASSIGNED"
-            non_groupable_ids.add(base_client_of.id)
+            of_index.mark_non_groupable(base_client_of)
             print(f"[GROUPING] OF {base_client_of.id} ignoré : date client {base_client_of.need_date:%Y-%m-%d} hors fenêtre {window_start_date:%Y-%m-%d} - {window_end_date:%Y-%m-%d}.")
             continue
         
 
         # 5) créer le groupe
         current_group = Group(
-            f"GRP{group_counter}",
+            f"{group_id_prefix}{group_counter}",
             main_premix,
             base_client_of,
             window_start_date,
             window_end_date
         )
+        of_index.mark_assigned(base_client_of)
 
         # init des stocks demandés
         for comp_id_norm, qty_needed in needed_components.items():
@@ -658,171 +2147,284 @@ def run_grouping_algorithm(all_ofs, bom_data, horizon_H_weeks_param):
         )
 
         # 6) ajouter les OF de premix dans la fenêtre
-        available_ofs_in_window = [
-            of for of in all_ofs
-            if of.assigned_group_id is None
-            and window_start_date <= of.need_date <= window_end_date
-        ]
-        for ps_of in sorted(available_ofs_in_window, key=lambda o: o.need_date):
-            prod_norm = norm(ps_of.product_id)
+        available_ofs_in_window = of_index.unassigned_in_window(window_start_date, window_end_date)
+        for ps_of in available_ofs_in_window:
+            prod_norm = ps_of.product_key
             if prod_norm in needed_components and prod_norm in real_premix_ids:
-                current_group.add_of(ps_of, ps_quantity_change=ps_of.quantity)
+                assign(current_group, ps_of, ps_quantity_change=ps_of.quantity)
                 current_group.component_stocks[prod_norm] = current_group.component_stocks.get(prod_norm, 0.0) + ps_of.quantity
-                family_product_ids.add(prod_norm)
+                extend_family((prod_norm,))
                 print(f"  Added Premix OF {ps_of.id} ({ps_of.product_id}) to {current_group.id}")
 
         # 6bis) 👉 ajouter les PARENTS du premix si on les trouve dans la même fenêtre
         parents_of_main_premix = child_to_parents.get(main_premix, set())
         for parent_prod in parents_of_main_premix:
-            parent_ofs = [
-                of for of in all_ofs
-                if of.assigned_group_id is None
-                and norm(of.product_id) == parent_prod
-                and window_start_date <= of.need_date <= window_end_date
-            ]
+            parent_ofs = of_index.unassigned_in_range(parent_prod, window_start_date, window_end_date)
             for pof in parent_ofs:
-                current_group.add_of(pof, ps_quantity_change=0)
-                family_product_ids.add(parent_prod)
+                assign(current_group, pof)
+                extend_family((parent_prod,))
                 print(f"  Added PARENT OF {pof.id} ({pof.product_id}) to {current_group.id} (parent of premix {main_premix})")
 
         # 7) ajouter autres PF/SF même famille
         other_client_ofs = [
-            of for of in all_ofs
+            of for of in of_index.unassigned_in_window(window_start_date, window_end_date)
             if of.product_type in ["PF", "SF"]
-            and of.assigned_group_id is None
             and of.id != base_client_of.id
-            and window_start_date <= of.need_date <= window_end_date
         ]
 
-        for client_of in sorted(other_client_ofs, key=lambda o: o.need_date):
-            client_needed_components = {}
-            for bom_entry in bom_data:
-                qty_needed = find_qty_of_component_in_product(
-                    client_of.product_id,
-                    bom_entry.child_product_id,
-                    bom_data
-                )
-                if qty_needed > 0:
-                    child_norm = norm(bom_entry.child_product_id)
-                    client_needed_components[child_norm] = client_needed_components.get(child_norm, 0.0) + qty_needed * client_of.quantity
-
-            is_direct_component = norm(client_of.product_id) in family_product_ids
-            shared_components = any(cid in family_product_ids for cid in client_needed_components.keys())
-            same_family = is_direct_component or shared_components
+        for client_of in other_client_ofs:
+            # membre direct de la famille ou consommateur d'un de ses composants
+            same_family = client_of.product_key in family_clients
 
             if same_family:
-                current_group.add_of(client_of, ps_quantity_change=0)
+                client_needed_components = client_requirements[id(client_of)]
+                assign(current_group, client_of)
 
                 if client_of.product_type == "SF":
-                    current_group.component_stocks[norm(client_of.product_id)] = (
-                        current_group.component_stocks.get(norm(client_of.product_id), 0.0) + client_of.quantity
+                    current_group.component_stocks[client_of.product_key] = (
+                        current_group.component_stocks.get(client_of.product_key, 0.0) + client_of.quantity
                     )
 
                 for cid, qn in client_needed_components.items():
                     current_group.component_stocks[cid] = current_group.component_stocks.get(cid, 0.0) - qn
                     needed_components[cid] = needed_components.get(cid, 0.0) + qn
 
-                family_product_ids.add(norm(client_of.product_id))
-                family_product_ids.update(client_needed_components.keys())
+                extend_family((client_of.product_key,))
+                extend_family(client_needed_components.keys())
                 print(f"  Added family OF {client_of.id} ({client_of.product_type}) to {current_group.id}")
 
         # 8) calcul conso
-        current_group.calculate_consumption(bom_data)
+        current_group.calculate_consumption(bom_graph)
 
         # 9) contrôle final
-        ofs_in_that_group = [of for of in all_ofs if of.assigned_group_id == current_group.id]
-        has_real_premix = any(norm(of.product_id) in real_premix_ids for of in ofs_in_that_group)
+        ofs_in_that_group = current_group.ofs
+        has_real_premix = any(of.product_key in real_premix_ids for of in ofs_in_that_group)
 
         if (len(ofs_in_that_group) <= 1) or (not has_real_premix):
             for of in ofs_in_that_group:
                 of.assigned_group_id = None
                 of.status = "UNASSIGNED"
                 of.individual_product_stock = 0
-                non_groupable_ids.add(of.id)
+                of_index.mark_non_groupable(of)
+                of_index.mark_unassigned(of)
             print(f"[GROUPING] {current_group.id} discarded (no real premix or single OF).")
         else:
-            groups.append(current_group)
             group_counter += 1
+            yield base_client_of, current_group
 
-    # rapport final
-    unassigned_ofs_final = [of for of in all_ofs if of.assigned_group_id is None]
-    if unassigned_ofs_final:
-        print("\nWarning: Some OFs remain unassigned after grouping:")
-        for of in unassigned_ofs_final:
-            print(f"  - {of}")
-
-    return groups, all_ofs
-
-
-def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map, operations_map, params):
-    print("\n--- Starting Detailed Smoothing and Scheduling ---")
-
-    print("[DEBUG] Stocks avant scheduling:")
-    for of in all_ofs_with_groups:
-        if of.assigned_group_id:
-            print(f"  {of.id} ({of.product_id}): stock = {of.individual_product_stock}")
+def iter_grouping_pipeline(all_ofs, bom_data, horizon_H_weeks_param, posts_map, operations_map, params, output_filepath=None):
+    """
+    Mode flux : chaque groupe est planifié, sa consommation calculée et son bloc écrit
+    dans output_filepath dès qu'il passe le contrôle final du groupement, sans attendre
+    la liste complète. Génère (groupe, OFs planifiés du groupe) ; la section des OFs non
+    affectés est écrite une fois le groupement terminé.
+    Les groupes sont planifiés dans leur ordre de création et non par début de fenêtre
+    comme dans smooth_and_schedule_groups : la répartition de charge sur les postes peut
+    donc différer du mode liste, le groupement lui est identique. Seul le moteur
+    séquentiel planifie groupe par groupe : "dispatch" est refusé.
+    """
+    scheduling_engine = params.get("scheduling_engine", SCHEDULING_ENGINE)
+    if scheduling_engine not in SCHEDULING_ENGINES:
+        raise ValueError(f"Unknown scheduling engine {scheduling_engine!r}. Expected one of {SCHEDULING_ENGINES}.")
+    if scheduling_engine == "dispatch":
+        raise ValueError("The dispatch scheduling engine needs every group up front; use smooth_and_schedule_groups.")
+    bom_graph = as_bom_graph(bom_data)
+    position = {id(of): pos for pos, of in enumerate(all_ofs)}
+    apply_time_granularity(posts_map, params)
+    operations_map = as_routing_table(operations_map, posts_map)
+    out = GroupedNeedsWriter(output_filepath) if output_filepath else None
+    if out:
+        print(f"\nWriting grouped needs to {output_filepath} (streaming)")
+    try:
+        for _, group in _iter_group_ofs(all_ofs, bom_graph, horizon_H_weeks_param):
+            ofs_in_group_sorted = sorted(group.ofs, key=lambda x: (-x.bom_level, x.need_date, position[id(x)]))
+            scheduled_ofs = _schedule_group(group, ofs_in_group_sorted, posts_map, operations_map, params)
+            group.calculate_consumption(bom_graph)
+            if out:
+                out.write_group(group, sorted(group.ofs, key=lambda x: position[id(x)]))
+            yield group, scheduled_ofs
+        if out:
+            out.write_unassigned([of for of in all_ofs if of.assigned_group_id is None])
+    finally:
+        if out:
+            out.close()
+
+def partition_ofs_by_family(all_ofs, bom_graph):
+    """
+    Répartit les OFs par famille de nomenclature (composantes connexes, union-find).
+    Les OFs dont le produit est absent de la nomenclature ne peuvent jamais être
+    groupés et ne sont rattachés à aucune partition.
+    """
+    families = bom_graph.families()
+    partitions = defaultdict(list)
+    for of in all_ofs:
+        family = families.get(of.product_key)
+        if family is not None:
+            partitions[family].append(of)
+    return dict(partitions)
+
+_WORKER_BOM_GRAPH = None
+
+def _init_grouping_worker(bom_graph):
+    global _WORKER_BOM_GRAPH
+    _WORKER_BOM_GRAPH = bom_graph
+
+def _group_partition(task):
+    task_id, ofs, horizon_H_weeks_param = task
+    groups = _group_ofs(ofs, _WORKER_BOM_GRAPH, horizon_H_weeks_param, group_id_prefix=f"TMP{task_id}_")
+    # membres repérés par rang dans la partition (les Order Codes peuvent être en double)
+    rank = {id(of): i for i, of in enumerate(ofs)}
+    return ofs, [(rank[id(base_of)], [rank[id(of)] for of in group.ofs], group) for base_of, group in groups]
+
+def _run_grouping_parallel(all_ofs, bom_graph, horizon_H_weeks_param, parallel_workers):
+    """
+    Groupe chaque famille dans un processus, puis fusionne. Les OFs de base sont choisis
+    dans l'ordre croissant de (-niveau, date, désignation, rang fichier) ; trier les groupes
+    conservés selon cette clé redonne donc la numérotation de l'exécution séquentielle.
+    """
+    from concurrent.futures import ProcessPoolExecutor
 
-    def is_weekend(date_obj):
-        return date_obj.weekday() >= 5
+    partitions = partition_ofs_by_family(all_ofs, bom_graph)
+    if len(partitions) <= 1:
+        return [group for _, group in _group_ofs(all_ofs, bom_graph, horizon_H_weeks_param)]
 
-    all_scheduled_ofs = []
+    position = {id(of): pos for pos, of in enumerate(all_ofs)}
+    # les plus grosses familles d'abord pour équilibrer la charge
+    tasks = [
+        (task_id, ofs, horizon_H_weeks_param)
+        for task_id, (_, ofs) in enumerate(sorted(partitions.items(), key=lambda item: (-len(item[1]), item[0])))
+    ]
+    print(f"[GROUPING] {len(tasks)} independent families, {parallel_workers} worker processes.")
+
+    merged = []
+    with ProcessPoolExecutor(max_workers=parallel_workers, initializer=_init_grouping_worker, initargs=(bom_graph,)) as pool:
+        for (_, task_ofs, _), (worker_ofs, worker_groups) in zip(tasks, pool.map(_group_partition, tasks)):
+            # les OFs reviennent copiés, dans l'ordre de la tâche : on reporte leur état
+            # sur les objets d'origine
+            for original, worker_of in zip(task_ofs, worker_ofs):
+                original.assigned_group_id = worker_of.assigned_group_id
+                original.status = worker_of.status
+                original.individual_product_stock = worker_of.individual_product_stock
+            for base_rank, member_ranks, group in worker_groups:
+                group.ofs = [task_ofs[i] for i in member_ranks]
+                base_of = task_ofs[base_rank]
+                key = (-base_of.bom_level, base_of.need_date, base_of.designation, position[id(base_of)])
+                merged.append((key, group))
+
+    merged.sort(key=lambda item: item[0])
+    groups = []
+    for number, (_, group) in enumerate(merged, 1):
+        group.id = f"GRP{number}"
+        for of in group.ofs:
+            of.assigned_group_id = group.id
+        groups.append(group)
+    return groups
 
-    for group in sorted(groups, key=lambda g: g.time_window_start):
-        print(f"\nSmoothing Group {group.id} (Window: {group.time_window_start.strftime('%Y-%m-%d')} - {group.time_window_end.strftime('%Y-%m-%d')})")
-        
-        ofs_in_group_sorted = sorted(
-            [of for of in all_ofs_with_groups if of.assigned_group_id == group.id],
-            key=lambda x: (-x.bom_level, x.need_date)
-        )
 
-        for of_to_schedule in ofs_in_group_sorted:
-            print(f"  Attempting to schedule OF {of_to_schedule.id} ({of_to_schedule.designation}), Need Date: {of_to_schedule.need_date.strftime('%Y-%m-%d')}")
+def _place_of_backward(of_to_schedule, routing, op_keys, earliest_start_dt, params):
+    """
+    Placement au plus tard (juste-à-temps) : la dernière opération finit au plus près de
+    la date de besoin et la gamme est remontée à l'envers, chaque opération finissant
+    avant le début de la suivante. Les créneaux sont réservés au fil de l'eau ; si une
+    opération ne trouve pas de place après earliest_start_dt, tout est libéré et None
+    est retourné.
+    """
+    latest_end_dt = of_to_schedule.need_date
+    if isinstance(latest_end_dt, date) and not isinstance(latest_end_dt, datetime):
+        latest_end_dt = datetime.combine(latest_end_dt, time.min)
+
+    details = []
+    for (op_def, post_obj, _), op_key in zip(reversed(routing), reversed(op_keys)):
+        op_start_dt = op_end_dt = None
+        if post_obj:
+            op_start_dt, op_end_dt = post_obj.find_latest_slot(
+                latest_end_dt,
+                op_def.standard_time_hours,
+                earliest_start_dt,
+                of_id_to_ignore=op_key,
+                respect_weekly_capacity=params.get("respect_weekly_capacity", True)
+            )
+        if not (op_start_dt and op_end_dt):
+            for detail in details:
+                detail['post_obj'].clear_schedule_for_of(detail['op_key'])
+            return None
+        print(f"      Op {op_def.operation_name} on {post_obj.id} placed backward: {op_start_dt.strftime('%Y-%m-%d %H:%M')} - {op_end_dt.strftime('%Y-%m-%d %H:%M')}")
+        post_obj.book_slot(op_start_dt, op_end_dt, op_key)
+        details.append({'op_def': op_def, 'post_obj': post_obj, 'op_key': op_key, 'start_dt': op_start_dt, 'end_dt': op_end_dt})
+        latest_end_dt = op_start_dt
+
+    details.reverse()
+    return details
+
+def _schedule_group(group, ofs_in_group_sorted, posts_map, operations_map, params):
+    """
+    Planifie les OFs d'un groupe, dans l'ordre donné, sur la capacité restante des postes :
+    au plus tôt (params["scheduling_direction"] = "forward", défaut) ou au plus tard avant
+    la date de besoin ("backward", repli au plus tôt si la gamme ne tient pas).
+    """
+    scheduling_direction = params.get("scheduling_direction", SCHEDULING_DIRECTION)
+    if scheduling_direction not in SCHEDULING_DIRECTIONS:
+        raise ValueError(f"Unknown scheduling direction {scheduling_direction!r}. Expected one of {SCHEDULING_DIRECTIONS}.")
+    routing_table = as_routing_table(operations_map, posts_map)
+    print(f"\nSmoothing Group {group.id} (Window: {group.time_window_start.strftime('%Y-%m-%d')} - {group.time_window_end.strftime('%Y-%m-%d')})")
+
+    scheduled_ofs = []
+    for of_to_schedule in ofs_in_group_sorted:
+        print(f"  Attempting to schedule OF {of_to_schedule.id} ({of_to_schedule.designation}), Need Date: {of_to_schedule.need_date.strftime('%Y-%m-%d')}")
+
+        routing = routing_table.routing(of_to_schedule.product_id, of_to_schedule.product_type)
+
+        if not routing:
+            print(f"    Warning: No operations found for OF {of_to_schedule.id} (Product ID: {of_to_schedule.product_id}, Type: {of_to_schedule.product_type}). Skipping.")
+            of_to_schedule.status = "FAILED_PLANNING_NO_OPS"
+            scheduled_ofs.append(of_to_schedule)
+            continue
 
-            of_operations = operations_map.get(of_to_schedule.product_id, [])
-            if not of_operations:
-                of_operations = operations_map.get(of_to_schedule.product_type, [])
+        op_keys = [of_to_schedule.id + step.key_suffix for step in routing]
 
-            if not of_operations:
-                print(f"    Warning: No operations found for OF {of_to_schedule.id} (Product ID: {of_to_schedule.product_id}, Type: {of_to_schedule.product_type}). Skipping.")
-                of_to_schedule.status = "FAILED_PLANNING_NO_OPS"
-                all_scheduled_ofs.append(of_to_schedule)
-                continue
+        current_of_scheduled_start_date = None
+        current_of_scheduled_end_date = None
+        possible_to_schedule_of = True
+        last_op_end_datetime = None
 
-            of_operations_sorted = sorted(of_operations, key=lambda op: op.sequence)
-            
-            current_of_scheduled_start_date = None
-            current_of_scheduled_end_date = None
-            possible_to_schedule_of = True
-            last_op_end_datetime = None
-
-            for op_def in of_operations_sorted:
-                post_obj = posts_map.get(op_def.post_id)
-                if post_obj:
-                    post_obj.clear_schedule_for_of(of_to_schedule.id + "_" + op_def.operation_name)
-
-            adv_retreat_delta = timedelta(weeks=params.get("advance_retreat_weeks", ADVANCE_RETREAT_WEEKS))
-            earliest_start_date_boundary = of_to_schedule.need_date - adv_retreat_delta
-            latest_start_date_boundary_for_first_op = of_to_schedule.need_date + adv_retreat_delta
-
-            initial_search_start_dt = max(
-                group.time_window_start,
-                earliest_start_date_boundary 
-            )
-            if isinstance(initial_search_start_dt, date) and not isinstance(initial_search_start_dt, datetime):
-                initial_search_start_dt = datetime.combine(initial_search_start_dt, time.min)
+        for step, op_key in zip(routing, op_keys):
+            if step.post:
+                step.post.clear_schedule_for_of(op_key)
 
-            op_schedule_details = []
-            last_op_end_datetime = None
+        adv_retreat_delta = timedelta(weeks=params.get("advance_retreat_weeks", ADVANCE_RETREAT_WEEKS))
+        earliest_start_date_boundary = of_to_schedule.need_date - adv_retreat_delta
+        latest_start_date_boundary_for_first_op = of_to_schedule.need_date + adv_retreat_delta
 
-            for i, op_def in enumerate(of_operations_sorted):
-                post_obj = posts_map.get(op_def.post_id)
+        initial_search_start_dt = max(
+            group.time_window_start,
+            earliest_start_date_boundary 
+        )
+        if isinstance(initial_search_start_dt, date) and not isinstance(initial_search_start_dt, datetime):
+            initial_search_start_dt = datetime.combine(initial_search_start_dt, time.min)
+
+        op_schedule_details = []
+        last_op_end_datetime = None
+
+        backward_details = None
+        if scheduling_direction == "backward":
+            backward_details = _place_of_backward(of_to_schedule, routing, op_keys, initial_search_start_dt, params)
+            if not backward_details:
+                print(f"    OF {of_to_schedule.id}: no backward slot before need date {of_to_schedule.need_date.strftime('%Y-%m-%d')}, falling back to forward scheduling.")
+
+        if backward_details:
+            op_schedule_details = backward_details
+            current_of_scheduled_start_date = backward_details[0]['start_dt']
+            current_of_scheduled_end_date = backward_details[-1]['end_dt']
+        else:
+            for i, (op_def, post_obj, _) in enumerate(routing):
+                op_key = op_keys[i]
                 if not post_obj:
                     print(f"    Warning: Post {op_def.post_id} for operation {op_def.operation_name} of OF {of_to_schedule.id} not found.")
                     possible_to_schedule_of = False
                     break
 
                 op_duration_hours = op_def.standard_time_hours
-                
+            
                 current_op_search_start_dt = last_op_end_datetime if last_op_end_datetime else initial_search_start_dt
                 current_op_search_start_dt = post_obj._get_next_working_datetime(current_op_search_start_dt)
 
@@ -836,7 +2438,8 @@ def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map,
                 op_start_dt, op_end_dt = post_obj.find_available_slot(
                     current_op_search_start_dt, 
                     op_duration_hours,
-                    of_id_to_ignore=of_to_schedule.id + "_" + op_def.operation_name
+                    of_id_to_ignore=op_key,
+                    respect_weekly_capacity=params.get("respect_weekly_capacity", True)
                 )
 
                 if op_start_dt and op_end_dt:
@@ -846,13 +2449,15 @@ def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map,
                         print(f"    OF {of_to_schedule.id}, Op {op_def.operation_name}: Found slot {op_start_dt.strftime('%Y-%m-%d %H:%M')} is beyond latest boundary {boundary_str}.")
                         possible_to_schedule_of = False
                         break 
-                    
+                
                     print(f"      Op {op_def.operation_name} on {post_obj.id} tentatively scheduled: {op_start_dt.strftime('%Y-%m-%d %H:%M')} - {op_end_dt.strftime('%Y-%m-%d %H:%M')}")
-                    op_schedule_details.append({'op_def': op_def, 'post_obj': post_obj, 'start_dt': op_start_dt, 'end_dt': op_end_dt})
-                    
+                    op_schedule_details.append({'op_def': op_def, 'post_obj': post_obj, 'op_key': op_key, 'start_dt': op_start_dt, 'end_dt': op_end_dt})
+                    # réservé tout de suite pour que la charge des opérations suivantes en tienne compte
+                    post_obj.book_slot(op_start_dt, op_end_dt, op_key)
+                
                     if i == 0:
                         current_of_scheduled_start_date = op_start_dt
-                    
+                
                     last_op_end_datetime = op_end_dt
                     current_of_scheduled_end_date = op_end_dt
                 else:
@@ -860,33 +2465,220 @@ def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map,
                     possible_to_schedule_of = False
                     break
 
-            if possible_to_schedule_of and op_schedule_details:
-                for detail in op_schedule_details:
-                    detail['post_obj'].book_slot(detail['start_dt'], detail['end_dt'], of_to_schedule.id + "_" + detail['op_def'].operation_name)
-                
-                of_to_schedule.scheduled_start_date = current_of_scheduled_start_date
-                of_to_schedule.scheduled_end_date = current_of_scheduled_end_date
-
-                latest_boundary_date_final = latest_start_date_boundary_for_first_op.date() if isinstance(latest_start_date_boundary_for_first_op, datetime) else latest_start_date_boundary_for_first_op
-                earliest_boundary_date_final = earliest_start_date_boundary.date() if isinstance(earliest_start_date_boundary, datetime) else earliest_start_date_boundary
-                if (earliest_boundary_date_final <= of_to_schedule.scheduled_start_date.date() <= latest_boundary_date_final):
-                    of_to_schedule.status = "PLANNED"
-                    print(f"    OF {of_to_schedule.id} PLANNED. Start: {of_to_schedule.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}, End: {of_to_schedule.scheduled_end_date.strftime('%Y-%m-%d %H:%M')}")
-                else:
-                    of_to_schedule.status = "PLANNED_OUTSIDE_WINDOW"
-                    print(f"    OF {of_to_schedule.id} PLANNED_OUTSIDE_WINDOW. Need: {of_to_schedule.need_date.strftime('%Y-%m-%d')}, Start: {of_to_schedule.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}")
-            
+        if possible_to_schedule_of and op_schedule_details:
+            of_to_schedule.scheduled_start_date = current_of_scheduled_start_date
+            of_to_schedule.scheduled_end_date = current_of_scheduled_end_date
+
+            latest_boundary_date_final = latest_start_date_boundary_for_first_op.date() if isinstance(latest_start_date_boundary_for_first_op, datetime) else latest_start_date_boundary_for_first_op
+            earliest_boundary_date_final = earliest_start_date_boundary.date() if isinstance(earliest_start_date_boundary, datetime) else earliest_start_date_boundary
+            if (earliest_boundary_date_final <= of_to_schedule.scheduled_start_date.date() <= latest_boundary_date_final):
+                of_to_schedule.status = "PLANNED"
+                print(f"    OF {of_to_schedule.id} PLANNED. Start: {of_to_schedule.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}, End: {of_to_schedule.scheduled_end_date.strftime('%Y-%m-%d %H:%M')}")
             else:
-                of_to_schedule.status = "FAILED_PLANNING"
-                print(f"    OF {of_to_schedule.id} FAILED_PLANNING (could not schedule all operations).")
+                of_to_schedule.status = "PLANNED_OUTSIDE_WINDOW"
+                print(f"    OF {of_to_schedule.id} PLANNED_OUTSIDE_WINDOW. Need: {of_to_schedule.need_date.strftime('%Y-%m-%d')}, Start: {of_to_schedule.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}")
+        
+        else:
+            for detail in op_schedule_details:
+                detail['post_obj'].clear_schedule_for_of(detail['op_key'])
+            of_to_schedule.status = "FAILED_PLANNING"
+            print(f"    OF {of_to_schedule.id} FAILED_PLANNING (could not schedule all operations).")
+
+        scheduled_ofs.append(of_to_schedule)
+
+    return scheduled_ofs
+
+class _DispatchJob:
+    """OF en cours de simulation dans le moteur dispatch."""
+    def __init__(self, of, routing, priority, release_dt, earliest_boundary_date, latest_boundary_date):
+        self.of = of
+        self.routing = routing
+        self.op_keys = [of.id + step.key_suffix for step in routing]
+        self.priority = priority
+        self.release_dt = release_dt
+        self.earliest_boundary_date = earliest_boundary_date
+        self.latest_boundary_date = latest_boundary_date
+        self.booked = []    # (poste, clé, début, fin) des opérations déjà placées
+        self.failed = False
 
-            all_scheduled_ofs.append(of_to_schedule)
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
 
-    final_of_map = {of.id: of for of in all_scheduled_ofs}
+def _dispatch_schedule(ordered_groups, all_ofs_with_groups, posts_map, routing_table, params):
+    """
+    Moteur "dispatch" : simulation à événements discrets de l'atelier. Chaque poste a une
+    file des opérations prêtes, ordonnée comme le moteur séquentiel (rang du groupe, niveau
+    BOM décroissant, date de besoin) ; dès qu'un poste se libère il prend la tête de sa
+    file. La première opération d'un OF est prête au début de sa fenêtre de recherche,
+    les suivantes à la fin de la précédente. Chaque opération passe une fois par sa file
+    et par l'échéancier, d'où un seul balayage en O(N log N) pour N opérations.
+    Les statuts et bornes de fenêtre sont ceux de _schedule_group (au plus tôt seulement).
+    """
+    adv_retreat_delta = timedelta(weeks=params.get("advance_retreat_weeks", ADVANCE_RETREAT_WEEKS))
+    respect_weekly_capacity = params.get("respect_weekly_capacity", True)
+    groups_by_id = {group.id: group for group in ordered_groups}
+    group_rank = {group.id: rank for rank, group in enumerate(ordered_groups)}
+
+    events = []                  # échéancier : (date, n°, poste, entrée de file ou None = poste libéré)
+    queues = defaultdict(list)   # poste -> tas de (priorité, n°, job, étape)
+    busy_until = {}              # poste -> fin de l'opération en cours
+    busy_with = {}               # poste -> clé de réservation de l'opération en cours
+    sequence = 0
+
+    def push_event(at_dt, post, entry=None):
+        nonlocal sequence
+        sequence += 1
+        heapq.heappush(events, (at_dt, sequence, post, entry))
+
+    def ready_entry(job, step_idx):
+        nonlocal sequence
+        sequence += 1
+        return job.priority, sequence, job, step_idx
+
+    def fail(job, reason, now=None):
+        job.failed = True
+        for post, op_key, _, _ in job.booked:
+            post.clear_schedule_for_of(op_key)
+            # poste encore occupé par cet OF : il redevient libre tout de suite
+            if now is not None and busy_with.get(post.id) == op_key and busy_until[post.id] > now:
+                busy_until[post.id] = now
+                del busy_with[post.id]
+                push_event(now, post)
+        job.of.status = "FAILED_PLANNING"
+        print(f"    OF {job.of.id} FAILED_PLANNING ({reason}).")
+
+    def finish(job):
+        of = job.of
+        of.scheduled_start_date = job.booked[0][2]
+        of.scheduled_end_date = job.booked[-1][3]
+        if job.earliest_boundary_date <= of.scheduled_start_date.date() <= job.latest_boundary_date:
+            of.status = "PLANNED"
+            print(f"    OF {of.id} PLANNED. Start: {of.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}, End: {of.scheduled_end_date.strftime('%Y-%m-%d %H:%M')}")
+        else:
+            of.status = "PLANNED_OUTSIDE_WINDOW"
+            print(f"    OF {of.id} PLANNED_OUTSIDE_WINDOW. Need: {of.need_date.strftime('%Y-%m-%d')}, Start: {of.scheduled_start_date.strftime('%Y-%m-%d %H:%M')}")
+
+    def dispatch(post, now):
+        queue = queues[post.id]
+        while queue:
+            _, _, job, step_idx = heapq.heappop(queue)
+            if job.failed:
+                continue
+            op_def = job.routing[step_idx].operation
+            op_key = job.op_keys[step_idx]
+            op_start_dt, op_end_dt = post.find_available_slot(
+                now,
+                op_def.standard_time_hours,
+                of_id_to_ignore=op_key,
+                respect_weekly_capacity=respect_weekly_capacity
+            )
+            if not (op_start_dt and op_end_dt):
+                fail(job, f"no slot for Op {op_def.operation_name} on {post.id}", now)
+                continue
+            if step_idx == 0 and op_start_dt.date() > job.latest_boundary_date:
+                fail(job, f"first slot {op_start_dt.strftime('%Y-%m-%d %H:%M')} beyond latest boundary {job.latest_boundary_date}", now)
+                continue
+            post.book_slot(op_start_dt, op_end_dt, op_key)
+            job.booked.append((post, op_key, op_start_dt, op_end_dt))
+            busy_until[post.id] = op_end_dt
+            busy_with[post.id] = op_key
+            push_event(op_end_dt, post)
+            if step_idx + 1 < len(job.routing):
+                push_event(op_end_dt, job.routing[step_idx + 1].post, ready_entry(job, step_idx + 1))
+            else:
+                finish(job)
+            return
+
+    scheduled_ofs = []
+    for position, of in enumerate(all_ofs_with_groups):
+        group = groups_by_id.get(of.assigned_group_id)
+        if group is None:
+            continue
+        routing = routing_table.routing(of.product_id, of.product_type)
+        if not routing:
+            print(f"    Warning: No operations found for OF {of.id} (Product ID: {of.product_id}, Type: {of.product_type}). Skipping.")
+            of.status = "FAILED_PLANNING_NO_OPS"
+            scheduled_ofs.append(of)
+            continue
+        earliest_start_date_boundary = of.need_date - adv_retreat_delta
+        release_dt = max(group.time_window_start, earliest_start_date_boundary)
+        if isinstance(release_dt, date) and not isinstance(release_dt, datetime):
+            release_dt = datetime.combine(release_dt, time.min)
+        job = _DispatchJob(
+            of, routing,
+            (group_rank[group.id], -of.bom_level, of.need_date, position),
+            release_dt,
+            _as_date(earliest_start_date_boundary),
+            _as_date(of.need_date + adv_retreat_delta)
+        )
+        scheduled_ofs.append(of)
+        for step, op_key in zip(routing, job.op_keys):
+            if step.post:
+                step.post.clear_schedule_for_of(op_key)
+        missing = [step.operation.post_id for step in routing if not step.post]
+        if missing:
+            print(f"    Warning: Post(s) {missing} for OF {of.id} not found.")
+            fail(job, "unknown post")
+            continue
+        push_event(release_dt, routing[0].post, ready_entry(job, 0))
+
+    print(f"[DISPATCH] {len(scheduled_ofs)} OFs, {len(events)} released into the post queues.")
+    while events:
+        now = events[0][0]
+        woken = {}
+        while events and events[0][0] == now:
+            _, _, post, entry = heapq.heappop(events)
+            if entry is not None:
+                heapq.heappush(queues[post.id], entry)
+            woken[post.id] = post
+        for post_id, post in woken.items():
+            if busy_until.get(post_id, now) <= now:
+                dispatch(post, now)
+
+    return scheduled_ofs
+
+def apply_time_granularity(posts_map, params):
+    """Aligne l'unité de calendrier des postes sur params["time_granularity"] (défaut SCHEDULING_GRANULARITY)."""
+    time_granularity = params.get("time_granularity", SCHEDULING_GRANULARITY)
+    for post in posts_map.values():
+        post.set_time_granularity(time_granularity)
+
+def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map, operations_map, params):
+    print("\n--- Starting Detailed Smoothing and Scheduling ---")
+    scheduling_engine = params.get("scheduling_engine", SCHEDULING_ENGINE)
+    if scheduling_engine not in SCHEDULING_ENGINES:
+        raise ValueError(f"Unknown scheduling engine {scheduling_engine!r}. Expected one of {SCHEDULING_ENGINES}.")
+    if scheduling_engine == "dispatch" and params.get("scheduling_direction", SCHEDULING_DIRECTION) != "forward":
+        raise ValueError("The dispatch scheduling engine only schedules forward.")
+    apply_time_granularity(posts_map, params)
+    operations_map = as_routing_table(operations_map, posts_map)
+
+    print("[DEBUG] Stocks avant scheduling:")
+    for of in all_ofs_with_groups:
+        if of.assigned_group_id:
+            print(f"  {of.id} ({of.product_id}): stock = {of.individual_product_stock}")
+
+    def is_weekend(date_obj):
+        return date_obj.weekday() >= 5
+
+    all_scheduled_ofs = []
+
+    if scheduling_engine == "dispatch":
+        all_scheduled_ofs = _dispatch_schedule(sorted(groups, key=lambda g: g.time_window_start), all_ofs_with_groups, posts_map, operations_map, params)
+    else:
+        for group in sorted(groups, key=lambda g: g.time_window_start):
+            ofs_in_group_sorted = sorted(
+                [of for of in all_ofs_with_groups if of.assigned_group_id == group.id],
+                key=lambda x: (-x.bom_level, x.need_date)
+            )
+            all_scheduled_ofs.extend(_schedule_group(group, ofs_in_group_sorted, posts_map, operations_map, params))
+
+    # par objet et non par Order Code : deux lignes peuvent partager le même code
+    final_of_map = {id(of): of for of in all_scheduled_ofs}
     updated_all_ofs = []
     for original_of in all_ofs_with_groups:
-        if original_of.id in final_of_map:
-            updated_all_ofs.append(final_of_map[original_of.id])
+        if id(original_of) in final_of_map:
+            updated_all_ofs.append(final_of_map[id(original_of)])
         else:
             updated_all_ofs.append(original_of)
             if original_of.assigned_group_id and original_of.status not in ["PLANNED", "FAILED_PLANNING", "FAILED_PLANNING_NO_OPS", "PLANNED_OUTSIDE_WINDOW"]:
@@ -894,6 +2686,229 @@ def smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map,
 
     return updated_all_ofs
 
+class PlanningRun:
+    """
+    Instantané d'une exécution (OFs, groupes, postes et leurs réservations), point de
+    départ d'un recalcul incrémental. input_fingerprint identifie les entrées autres que
+    les besoins (nomenclature, postes, opérations, paramètres) : un recalcul incrémental
+    n'a de sens que si elles n'ont pas changé.
+    """
+    def __init__(self, all_ofs, groups, posts_map, horizon_H_weeks_param, params=None, input_fingerprint=None):
+        self.all_ofs = all_ofs
+        self.groups = groups
+        self.posts_map = posts_map
+        self.horizon_H_weeks_param = horizon_H_weeks_param
+        self.params = dict(params or {})
+        self.input_fingerprint = input_fingerprint
+
+    def save(self, filepath):
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, filepath)
+
+    @staticmethod
+    def load(filepath):
+        try:
+            with open(filepath, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Warning: previous planning run {filepath} unreadable ({e}).")
+            return None
+
+def of_row_keys(ofs):
+    """
+    Clé unique par ligne d'extraction : (Order Code, rang parmi les lignes de même
+    Order Code), de sorte que des codes en double restent des OFs distincts.
+    """
+    seen = defaultdict(int)
+    keys = []
+    for of in ofs:
+        keys.append((of.id, seen[of.id]))
+        seen[of.id] += 1
+    return keys
+
+def diff_ofs(previous_ofs, new_ofs):
+    """
+    Compare deux extractions de besoins ligne à ligne (clés de of_row_keys). Retourne
+    (ajoutés, supprimés, modifiés) sous forme d'ensembles de clés ; un OF est modifié si
+    son produit, sa quantité ou sa date de besoin change.
+    """
+    def signature(of):
+        return of.product_key, of.quantity, of.need_date
+
+    previous = {key: signature(of) for key, of in zip(of_row_keys(previous_ofs), previous_ofs)}
+    current = {key: signature(of) for key, of in zip(of_row_keys(new_ofs), new_ofs)}
+    added = current.keys() - previous.keys()
+    removed = previous.keys() - current.keys()
+    changed = {key for key in current.keys() & previous.keys() if current[key] != previous[key]}
+    return set(added), set(removed), changed
+
+def release_of_bookings(of, posts_map, operations_map):
+    """Libère les créneaux réservés pour les opérations d'un OF."""
+    for step in as_routing_table(operations_map, posts_map).routing(of.product_id, of.product_type):
+        if step.post:
+            step.post.clear_schedule_for_of(of.id + step.key_suffix)
+
+def run_incremental_regrouping(previous_run, new_ofs, bom_data, operations_map, params=None):
+    """
+    Recalcule uniquement les familles de nomenclature touchées par un OF ajouté, supprimé
+    ou modifié depuis previous_run. Les groupes des autres familles, leurs OFs et leurs
+    réservations de postes sont conservés tels quels ; les groupes recalculés sont planifiés
+    dans la capacité restante. Les familles étant indépendantes, le groupement obtenu est
+    celui d'un recalcul complet (numérotation GRP<n> comprise). previous_run (et ses
+    postes) est réutilisé en place.
+    """
+    bom_graph = as_bom_graph(bom_data)
+    params = dict(previous_run.params if params is None else params)
+    horizon_H_weeks_param = previous_run.horizon_H_weeks_param
+    posts_map = previous_run.posts_map
+    operations_map = as_routing_table(operations_map, posts_map)
+    families = bom_graph.families()
+
+    def family_of(of):
+        return families.get(of.product_key)
+
+    added, removed, changed = diff_ofs(previous_run.all_ofs, new_ofs)
+    previous_keys = of_row_keys(previous_run.all_ofs)
+    previous_by_key = dict(zip(previous_keys, previous_run.all_ofs))
+    new_by_key = dict(zip(of_row_keys(new_ofs), new_ofs))
+    dirty_families = set()
+    for key in added | removed | changed:
+        for of in (previous_by_key.get(key), new_by_key.get(key)):
+            if of is not None and family_of(of) is not None:
+                dirty_families.add(family_of(of))
+    print(f"[INCREMENTAL] {len(added)} added, {len(removed)} removed, {len(changed)} changed OFs; "
+          f"{len(dirty_families)} of {len(set(families.values()))} families to regroup.")
+
+    # 1) libérer les postes des OFs des familles recalculées
+    for of in previous_run.all_ofs:
+        if family_of(of) in dirty_families and of.assigned_group_id:
+            release_of_bookings(of, posts_map, operations_map)
+
+    # 2) reprendre tel quel l'état des OFs des familles intactes
+    for key, of in new_by_key.items():
+        previous_of = previous_by_key.get(key)
+        if previous_of is not None and family_of(of) not in dirty_families:
+            of.assigned_group_id = previous_of.assigned_group_id
+            of.status = previous_of.status
+            of.individual_product_stock = previous_of.individual_product_stock
+            of.scheduled_start_date = previous_of.scheduled_start_date
+            of.scheduled_end_date = previous_of.scheduled_end_date
+    kept_groups = [group for group in previous_run.groups if family_of(group.ofs[0]) not in dirty_families]
+    key_of_previous = {id(of): key for key, of in zip(previous_keys, previous_run.all_ofs)}
+    for group in kept_groups:
+        group.ofs = [new_by_key[key_of_previous[id(of)]] for of in group.ofs]
+
+    # 3) regrouper les familles touchées
+    dirty_ofs = [of for of in new_ofs if family_of(of) in dirty_families]
+    regrouped = [group for _, group in _group_ofs(dirty_ofs, bom_graph, horizon_H_weeks_param, group_id_prefix="NEW")]
+
+    # 4) numérotation globale : ordre de sélection des OFs de base (premier OF de chaque groupe)
+    position = {id(of): pos for pos, of in enumerate(new_ofs)}
+
+    def base_key(group):
+        base_of = group.ofs[0]
+        return (-base_of.bom_level, base_of.need_date, base_of.designation, position[id(base_of)])
+
+    groups = sorted(kept_groups + regrouped, key=base_key)
+    for number, group in enumerate(groups, 1):
+        group.id = f"GRP{number}"
+        for of in group.ofs:
+            of.assigned_group_id = group.id
+
+    # 5) planifier uniquement les groupes recalculés
+    scheduled_ofs = smooth_and_schedule_groups(regrouped, new_ofs, bom_graph, posts_map, operations_map, params)
+    return PlanningRun(scheduled_ofs, groups, posts_map, horizon_H_weeks_param, params, previous_run.input_fingerprint)
+
+_SWEEP_STATE = None
+
+def _init_sweep_worker(state):
+    global _SWEEP_STATE
+    _SWEEP_STATE = state
+
+def _sweep_task(combination):
+    return _sweep_scenario(_SWEEP_STATE, combination)
+
+def _sweep_scenario(state, combination):
+    """Planifie un couple (horizon, avance/retard) sur une copie du groupement et des postes."""
+    grouped_by_horizon, bom_graph, posts_map, operations_map, base_params = state
+    horizon_H_weeks_param, advance_retreat_weeks = combination
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        groups, ofs = copy.deepcopy(grouped_by_horizon[horizon_H_weeks_param])
+        params = dict(base_params, advance_retreat_weeks=advance_retreat_weeks)
+        scheduled_ofs = smooth_and_schedule_groups(groups, ofs, bom_graph, copy.deepcopy(posts_map), operations_map, params)
+    statuses = defaultdict(int)
+    total_delay_days = 0
+    for of in scheduled_ofs:
+        statuses[of.status] += 1
+        # même définition que la colonne Delay du fichier de sortie
+        if of.scheduled_start_date and of.need_date:
+            total_delay_days += max(0, (of.scheduled_start_date - of.need_date).days)
+    return {
+        "horizon_H_weeks": horizon_H_weeks_param,
+        "advance_retreat_weeks": advance_retreat_weeks,
+        "groups": len(groups),
+        "planned_ofs": statuses["PLANNED"],
+        "planned_outside_window_ofs": statuses["PLANNED_OUTSIDE_WINDOW"],
+        "failed_ofs": statuses["FAILED_PLANNING"] + statuses["FAILED_PLANNING_NO_OPS"],
+        "unassigned_ofs": sum(1 for of in scheduled_ofs if of.assigned_group_id is None),
+        "total_delay_days": total_delay_days,
+    }
+
+def run_parameter_sweep(all_ofs, bom_data, posts_map, operations_map, combinations, params=None, parallel_workers=None):
+    """
+    Évalue plusieurs couples (horizon_H_weeks, advance_retreat_weeks) sur les mêmes
+    entrées, chargées une seule fois. La nomenclature est compilée et explosée une fois ;
+    le groupement ne dépend que de l'horizon et n'est calculé qu'une fois par horizon
+    distinct, puis chaque couple est planifié sur sa propre copie des OFs et des postes
+    (dans des processus séparés si parallel_workers > 1). Les copies repartent d'OFs
+    non affectés et de postes sans réservation, comme une exécution complète, même si
+    les entrées ont déjà été traitées ; les entrées ne sont pas modifiées. Retourne un résumé par couple, dans l'ordre demandé et avec les valeurs
+    demandées ; un couple répété n'est évalué qu'une fois.
+    """
+    bom_graph = as_bom_graph(bom_data).precompute()
+    requested = [tuple(combination) for combination in combinations]
+    combinations = list(dict.fromkeys(requested))
+    grouped_by_horizon = {}
+    posts_map = copy.deepcopy(posts_map)
+    for post in posts_map.values():
+        post.clear_schedule()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for horizon_H_weeks_param, _ in combinations:
+            if horizon_H_weeks_param not in grouped_by_horizon:
+                ofs = copy.deepcopy(all_ofs)
+                for of in ofs:
+                    of.reset_planning()
+                groups = [group for _, group in _group_ofs(ofs, bom_graph, horizon_H_weeks_param)]
+                grouped_by_horizon[horizon_H_weeks_param] = (groups, ofs)
+    state = (grouped_by_horizon, bom_graph, posts_map, operations_map, dict(params or {}))
+    print(f"[SWEEP] {len(combinations)} combinations, {len(grouped_by_horizon)} distinct horizons.")
+
+    if parallel_workers and parallel_workers > 1 and len(combinations) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(parallel_workers, len(combinations)),
+                                 initializer=_init_sweep_worker, initargs=(state,)) as pool:
+            summaries = list(pool.map(_sweep_task, combinations))
+    else:
+        summaries = [_sweep_scenario(state, combination) for combination in combinations]
+    by_combination = dict(zip(combinations, summaries))
+    return [dict(by_combination[combination]) for combination in requested]
+
+def print_parameter_sweep(results):
+    """Affiche les résumés de run_parameter_sweep côte à côte."""
+    columns = [
+        ("horizon_H_weeks", "H (wk)"), ("advance_retreat_weeks", "Adv/Ret (wk)"), ("groups", "Groups"),
+        ("planned_ofs", "Planned"), ("planned_outside_window_ofs", "Outside win."),
+        ("failed_ofs", "Failed"), ("unassigned_ofs", "Unassigned"), ("total_delay_days", "Delay (d)"),
+    ]
+    widths = [max([len(title)] + [len(str(r[key])) for r in results]) for key, title in columns]
+    print("  ".join(title.rjust(w) for (_, title), w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[key]).rjust(w) for (key, _), w in zip(columns, widths)))
+
 def load_ofs_from_file(filepath):
     print(f"Loading OFs from {filepath}")
     ofs = []
@@ -1026,6 +3041,84 @@ def load_bom_from_file(filepath):
     print(f"Loaded {len(bom_entries)} BOM entries.")
     return bom_entries
 
+def file_content_hash(filepath):
+    """Hash SHA-256 du contenu d'un fichier (None si illisible)."""
+    try:
+        with open(filepath, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def _bom_cache_path(cache_dir, content_hash):
+    return os.path.join(cache_dir, f"bom_{content_hash}.pkl")
+
+def _evict_bom_cache(cache_dir, max_entries, max_bytes):
+    """Éviction LRU (date de dernier accès = mtime) au-delà de max_entries ou max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith("bom_") and name.endswith(".pkl"):
+            path = os.path.join(cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort(reverse=True)
+    kept_bytes = 0
+    for rank, (_, size, path) in enumerate(entries):
+        kept_bytes += size
+        if rank >= max_entries or kept_bytes > max_bytes:
+            try:
+                os.remove(path)
+                print(f"[BOM CACHE] Evicted {os.path.basename(path)}")
+            except OSError:
+                pass
+
+def load_bom_graph(filepath, cache_dir=BOM_CACHE_DIR, max_entries=BOM_CACHE_MAX_ENTRIES, max_bytes=BOM_CACHE_MAX_BYTES):
+    """
+    Charge la nomenclature et la compile en BOMGraph, via un cache disque indexé par
+    le hash SHA-256 du contenu du fichier : un fichier modifié change de clé, les
+    entrées périmées sont évincées (LRU). cache_dir=None désactive le cache.
+    """
+    content_hash = file_content_hash(filepath)
+    if content_hash is None:
+        return BOMGraph(load_bom_from_file(filepath))
+
+    cache_path = _bom_cache_path(cache_dir, content_hash) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            # beaucoup de petits conteneurs : le GC ralentit nettement le unpickle
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with open(cache_path, "rb") as f:
+                    version, state = pickle.load(f)
+                if version == BOM_CACHE_FORMAT_VERSION:
+                    bom_graph = BOMGraph.from_state(state)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            if version == BOM_CACHE_FORMAT_VERSION:
+                os.utime(cache_path)
+                print(f"[BOM CACHE] Hit for {filepath} ({len(bom_graph)} BOM entries).")
+                return bom_graph
+            os.remove(cache_path)
+        except Exception as e:
+            print(f"Warning: BOM cache entry {cache_path} unreadable ({e}). Rebuilding.")
+
+    bom_graph = BOMGraph(load_bom_from_file(filepath)).precompute()
+    if cache_path and len(bom_graph):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump((BOM_CACHE_FORMAT_VERSION, bom_graph.to_state()), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+            _evict_bom_cache(cache_dir, max_entries, max_bytes)
+        except OSError as e:
+            print(f"Warning: could not write BOM cache to {cache_dir}: {e}")
+    return bom_graph
+
 def load_posts_and_operations_data(filepath_posts, filepath_post_unavailability, filepath_operations):
     print(f"Loading Posts, Unavailability & Operations from {filepath_posts}, {filepath_post_unavailability}, {filepath_operations}")
     posts_map = {}
@@ -1094,167 +3187,148 @@ def load_posts_and_operations_data(filepath_posts, filepath_post_unavailability,
         print(f"Error loading Operations from {filepath_operations}: {e}")
 
     print(f"Loaded {len(posts_map)} posts and {sum(len(ops) for ops in operations_map.values())} operation rules.")
-    return posts_map, operations_map
-
-def write_grouped_needs_to_file(filepath, grouped_list_data, all_ofs_scheduled):
-    print(f"\nWriting grouped needs to {filepath}")
-    
-    output_header = [
-        "Part", "Description", "Order Code", "FG", "CAT", "US", "FS", "Qty",
-        "X3 Date", "GRP_FLG", "Start Date", "Delay", "Stock_Produit"
+    return posts_map, RoutingTable(operations_map, posts_map)
+
+GROUPED_NEEDS_HEADER = [
+    "Part", "Description", "Order Code", "FG", "CAT", "US", "FS", "Qty",
+    "X3 Date", "GRP_FLG", "Start Date", "Delay", "Stock_Produit"
+]
+
+def _output_display_class(of_obj):
+    # 0 = PF, 1 = SF non premix, 2 = premix
+    if (of_obj.designation or "").strip().upper().startswith("PREMIX"):
+        return 2
+    if of_obj.product_type == "PF":
+        return 0
+    # le reste (SF non premix)
+    return 1
+
+def _grouped_needs_row(of_obj, qty):
+    # description courte
+    desc_parts = of_obj.designation.split()
+    if not desc_parts:
+        processed_description = ""
+    elif len(desc_parts) >= 2 and desc_parts[0].upper() == "BATENS":
+        processed_description = f"{desc_parts[0]} {desc_parts[1]}"
+    elif len(desc_parts) == 1:
+        processed_description = desc_parts[0]
+    else:
+        processed_description = f"{desc_parts[0]} {desc_parts[1]}"
+
+    processed_order_code = of_obj.id[:10]
+    grp_flg = of_obj.assigned_group_id.replace("GRP", "") if of_obj.assigned_group_id else ""
+    start_date_str = of_obj.scheduled_start_date.strftime("%Y-%m-%d") if of_obj.scheduled_start_date else ""
+
+    delay_val = ""
+    if of_obj.scheduled_start_date and of_obj.need_date:
+        delay_days = (of_obj.scheduled_start_date - of_obj.need_date).days
+        delay_val = str(max(0, delay_days))
+
+    stock_val = getattr(of_obj, "individual_product_stock", None)
+    if stock_val is None:
+        stock_val = getattr(of_obj, "remaining_stock", 0.0)
+    if stock_val is None:
+        stock_val = 0.0
+
+    return [
+        of_obj.product_id,
+        processed_description,
+        processed_order_code,
+        of_obj.fg,
+        of_obj.cat,
+        of_obj.us,
+        of_obj.fs,
+        qty,
+        of_obj.need_date.strftime("%Y-%m-%d") if of_obj.need_date else "",
+        grp_flg,
+        start_date_str,
+        delay_val,
+        stock_val,
     ]
 
-    def is_premix(of_obj):
-        name = (of_obj.designation or "").strip().upper()
-        return name.startswith("PREMIX")
+class GroupedNeedsWriter:
+    """
+    Écriture incrémentale du fichier de besoins groupés : en-tête à l'ouverture,
+    un bloc par groupe, puis la section des OFs non affectés.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, "w", newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file, delimiter="\t")
+        self._writer.writerow(GROUPED_NEEDS_HEADER)
+
+    def write_group(self, group, ofs_in_group):
+        f = self._file
+        f.write(f"\n# Group ID: {group.id}\n")
+        f.write(f"#   Produit PS Principal: {group.ps_product_id}\n")
+        f.write(
+            f"#   Fenêtre Temporelle: {group.time_window_start.strftime('%Y-%m-%d')} "
+            f"à {group.time_window_end.strftime('%Y-%m-%d')}\n"
+        )
 
-    def display_class(of_obj):
-        # 0 = PF, 1 = SF non premix, 2 = premix
-        if is_premix(of_obj):
-            return 2
-        if of_obj.product_type == "PF":
-            return 0
-        # le reste (SF non premix)
-        return 1
+        if hasattr(group, "individual_product_stocks") and group.ps_product_id in group.individual_product_stocks:
+            f.write(f"#   Stock PS Calculé: {group.individual_product_stocks[group.ps_product_id]}\n")
+        else:
+            f.write("#   Stock PS: Non calculé\n")
 
-    with open(filepath, "w", newline='', encoding='utf-8') as f:
-        import csv
-        writer = csv.writer(f, delimiter="\t")
-        writer.writerow(output_header)
+        # >>> TRI demandé : PF -> SF -> PREMIX
+        ofs_in_group_sorted = sorted(
+            ofs_in_group,
+            key=lambda x: (
+                _output_display_class(x),      # 0 PF, 1 SF, 2 PREMIX
+                -x.bom_level,
+                x.need_date
+            )
+        )
+        for of_obj in ofs_in_group_sorted:
+            self._writer.writerow(_grouped_needs_row(of_obj, of_obj.source_qty))
 
-        processed_of_ids_in_groups = set()
+    def write_unassigned(self, unassigned_ofs):
+        self._file.write("\n# OFs Non Affectés:\n")
+        unassigned_sorted = sorted(
+            unassigned_ofs,
+            key=lambda x: (
+                _output_display_class(x),   # même logique PF -> SF -> PREMIX
+                x.id
+            )
+        )
+        for of_obj in unassigned_sorted:
+            self._writer.writerow(_grouped_needs_row(of_obj, int(of_obj.quantity)))
 
-        def extract_group_number(group):
-            try:
-                return int(group.id.replace("GRP", ""))
-            except Exception:
-                return 0
+    def close(self):
+        self._file.close()
 
-        # =============== GROUPES ===============
-        for group in sorted(grouped_list_data, key=extract_group_number):
-            f.write(f"\n# Group ID: {group.id}\n")
-            f.write(f"#   Produit PS Principal: {group.ps_product_id}\n")
-            f.write(
-                f"#   Fenêtre Temporelle: {group.time_window_start.strftime('%Y-%m-%d')} "
-                f"à {group.time_window_end.strftime('%Y-%m-%d')}\n"
-            )
+    def __enter__(self):
+        return self
 
-            if hasattr(group, "individual_product_stocks") and group.ps_product_id in group.individual_product_stocks:
-                f.write(f"#   Stock PS Calculé: {group.individual_product_stocks[group.ps_product_id]}\n")
-            else:
-                f.write("#   Stock PS: Non calculé\n")
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
-            # OF du groupe
-            ofs_in_group = [of for of in all_ofs_scheduled if of.assigned_group_id == group.id]
+def write_grouped_needs_to_file(filepath, grouped_list_data, all_ofs_scheduled):
+    print(f"\nWriting grouped needs to {filepath}")
 
-            # >>> TRI demandé : PF -> SF -> PREMIX
-            ofs_in_group_sorted = sorted(
-                ofs_in_group,
-                key=lambda x: (
-                    display_class(x),      # 0 PF, 1 SF, 2 PREMIX
-                    -x.bom_level,
-                    x.need_date
-                )
-            )
+    def extract_group_number(group):
+        try:
+            return int(group.id.replace("GRP", ""))
+        except Exception:
+            return 0
 
-            for of_obj in ofs_in_group_sorted:
-                # description courte
-                desc_parts = of_obj.designation.split()
-                if not desc_parts:
-                    processed_description = ""
-                elif len(desc_parts) >= 2 and desc_parts[0].upper() == "BATENS":
-                    processed_description = f"{desc_parts[0]} {desc_parts[1]}"
-                elif len(desc_parts) == 1:
-                    processed_description = desc_parts[0]
-                else:
-                    processed_description = f"{desc_parts[0]} {desc_parts[1]}"
-
-                processed_order_code = of_obj.id[:10]
-                grp_flg = of_obj.assigned_group_id.replace("GRP", "") if of_obj.assigned_group_id else ""
-                start_date_str = of_obj.scheduled_start_date.strftime("%Y-%m-%d") if of_obj.scheduled_start_date else ""
-
-                delay_val = ""
-                if of_obj.scheduled_start_date and of_obj.need_date:
-                    delay_days = (of_obj.scheduled_start_date - of_obj.need_date).days
-                    delay_val = str(max(0, delay_days))
-
-                stock_val = getattr(of_obj, "individual_product_stock", None)
-                if stock_val is None:
-                    stock_val = getattr(of_obj, "remaining_stock", 0.0)
-                if stock_val is None:
-                    stock_val = 0.0
-                
-                writer.writerow([
-                    of_obj.product_id,
-                    processed_description,
-                    processed_order_code,
-                    of_obj.fg,
-                    of_obj.cat,
-                    of_obj.us,
-                    of_obj.fs,
-                    of_obj.source_qty,
-                    of_obj.need_date.strftime("%Y-%m-%d") if of_obj.need_date else "",
-                    grp_flg,
-                    start_date_str,
-                    delay_val,
-                    stock_val,
-                ])
-
-                processed_of_ids_in_groups.add(of_obj.id)
+    ofs_by_group = defaultdict(list)
+    for of in all_ofs_scheduled:
+        if of.assigned_group_id:
+            ofs_by_group[of.assigned_group_id].append(of)
 
-        # =============== NON AFFECTÉS ===============
-        f.write("\n# OFs Non Affectés:\n")
-        unassigned = [of for of in all_ofs_scheduled if of.id not in processed_of_ids_in_groups]
+    with GroupedNeedsWriter(filepath) as out:
+        processed_of_ids_in_groups = set()
 
-        unassigned_sorted = sorted(
-            unassigned,
-            key=lambda x: (
-                display_class(x),   # même logique PF -> SF -> PREMIX
-                x.id
-            )
-        )
+        # =============== GROUPES ===============
+        for group in sorted(grouped_list_data, key=extract_group_number):
+            ofs_in_group = ofs_by_group.get(group.id, [])
+            out.write_group(group, ofs_in_group)
+            processed_of_ids_in_groups.update(of.id for of in ofs_in_group)
 
-        for of_obj in unassigned_sorted:
-            desc_parts = of_obj.designation.split()
-            if not desc_parts:
-                processed_description = ""
-            elif len(desc_parts) >= 2 and desc_parts[0].upper() == "BATENS":
-                processed_description = f"{desc_parts[0]} {desc_parts[1]}"
-            elif len(desc_parts) == 1:
-                processed_description = desc_parts[0]
-            else:
-                processed_description = f"{desc_parts[0]} {desc_parts[1]}"
-
-            processed_order_code = of_obj.id[:10]
-            grp_flg = of_obj.assigned_group_id.replace("GRP", "") if of_obj.assigned_group_id else ""
-            start_date_str = of_obj.scheduled_start_date.strftime("%Y-%m-%d") if of_obj.scheduled_start_date else ""
-
-            delay_val = ""
-            if of_obj.scheduled_start_date and of_obj.need_date:
-                delay_days = (of_obj.scheduled_start_date - of_obj.need_date).days
-                delay_val = str(max(0, delay_days))
-
-            stock_val = getattr(of_obj, "individual_product_stock", None)
-            if stock_val is None:
-                stock_val = getattr(of_obj, "remaining_stock", 0.0)
-            if stock_val is None:
-                stock_val = 0.0
-
-            writer.writerow([
-                of_obj.product_id,
-                processed_description,
-                processed_order_code,
-                of_obj.fg,
-                of_obj.cat,
-                of_obj.us,
-                of_obj.fs,
-                int(of_obj.quantity),
-                of_obj.need_date.strftime("%Y-%m-%d") if of_obj.need_date else "",
-                grp_flg,
-                start_date_str,
-                delay_val,
-                stock_val
-            ])
+        # =============== NON AFFECTÉS ===============
+        out.write_unassigned([of for of in all_ofs_scheduled if of.id not in processed_of_ids_in_groups])
 
     print(f"Output written to {filepath} with PF on top, premix at bottom.")
 
@@ -1326,20 +3400,27 @@ if __name__ == "__main__":
     if os.path.exists(compact_file):
         print(f"Mode compact détecté : chargement depuis {compact_file}")
         all_ofs, bom_data = load_compact_input_file(compact_file)
+        bom_graph = BOMGraph(bom_data)
     else:
         print("Mode classique : chargement des fichiers CSV classiques.")
         all_ofs = load_ofs_from_file(ofs_file)
-        bom_data = load_bom_from_file(bom_file)
+        bom_graph = load_bom_graph(bom_file)
 
     posts_map, operations_map = load_posts_and_operations_data(posts_file, post_unavailability_file, operations_file)
 
     params = {
-        "advance_retreat_weeks": ADVANCE_RETREAT_WEEKS
+        "advance_retreat_weeks": ADVANCE_RETREAT_WEEKS,
+        "time_granularity": SCHEDULING_GRANULARITY,
+        "scheduling_direction": SCHEDULING_DIRECTION,
+        "scheduling_engine": SCHEDULING_ENGINE
     }
 
-    groups, all_ofs_with_groups = run_grouping_algorithm(all_ofs, bom_data, HORIZON_H_WEEKS)
+    groups, all_ofs_with_groups = run_grouping_algorithm(all_ofs, bom_graph, HORIZON_H_WEEKS)
+
+    all_ofs_scheduled = smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_graph, posts_map, operations_map, params)
 
-    all_ofs_scheduled = smooth_and_schedule_groups(groups, all_ofs_with_groups, bom_data, posts_map, operations_map, params)
+    if INVENTORY_NETTING:
+        net_inventory_across_groups(groups, all_ofs_scheduled, bom_graph)
 
     write_grouped_needs_to_file(output_file, groups, all_ofs_scheduled)
 
@@ -1,8 +1,10 @@
 from flask import Flask, render_template, request, jsonify
+from werkzeug.utils import secure_filename
 import pandas as pd
 import os
 import re
 import json
+import hashlib
 import random
 from datetime import datetime, timedelta
 import random
@@ -13,11 +15,15 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Mise à jour des importations
 from sothemalgo_grouper import (
     load_ofs_from_file,
-    load_bom_from_file,
+    load_bom_graph,
     load_posts_and_operations_data,
     run_grouping_algorithm,
     smooth_and_schedule_groups,
     write_grouped_needs_to_file,
+    file_content_hash,
+    PlanningRun,
+    run_incremental_regrouping,
+    net_inventory_across_groups,
     HORIZON_H_WEEKS,  # Utilisé comme paramètre par défaut pour l'horizon
     # Assurez-vous que toutes les autres constantes ou fonctions nécessaires sont importées
 )
@@ -168,6 +174,25 @@ def parse_output_file(file_path):
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'uploads')
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Instantanés pickle des exécutions (recalcul incrémental) : hors du dossier des
+# téléversements, on ne désérialise jamais un fichier qu'un client peut écrire
+RUNS_DIR = os.path.join(BASE_DIR, 'runs')
+RUNS_MAX_FILES = 16
+
+def planning_run_path(input_fingerprint):
+    """Instantané propre à un jeu d'entrées : des utilisateurs aux fichiers différents ne s'écrasent pas."""
+    digest = hashlib.sha256(repr(input_fingerprint).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(RUNS_DIR, f'planning_run_{digest}.pkl')
+
+def prune_planning_runs(max_files=RUNS_MAX_FILES):
+    """Ne garde que les max_files instantanés les plus récents."""
+    try:
+        paths = [os.path.join(RUNS_DIR, name) for name in os.listdir(RUNS_DIR) if name.endswith('.pkl')]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[max_files:]:
+            os.remove(path)
+    except OSError as e:
+        app.logger.warning(f"Nettoyage des instantanés impossible : {e}")
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -187,7 +212,7 @@ def index():
         
         # Fichier besoins
         if besoins_file_storage and besoins_file_storage.filename:
-            besoins_path = os.path.join(app.config['UPLOAD_FOLDER'], besoins_file_storage.filename)
+            besoins_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(besoins_file_storage.filename))
             besoins_file_storage.save(besoins_path)
         else:
             if use_test_data:
@@ -198,7 +223,7 @@ def index():
 
         # Fichier nomenclature
         if nomenclature_file_storage and nomenclature_file_storage.filename:
-            nomenclature_path = os.path.join(app.config['UPLOAD_FOLDER'], nomenclature_file_storage.filename)
+            nomenclature_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(nomenclature_file_storage.filename))
             nomenclature_file_storage.save(nomenclature_path)
         else:
             if use_test_data:
@@ -209,7 +234,7 @@ def index():
 
         # Fichier posts
         if posts_file_storage and posts_file_storage.filename:
-            posts_path = os.path.join(app.config['UPLOAD_FOLDER'], posts_file_storage.filename)
+            posts_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(posts_file_storage.filename))
             posts_file_storage.save(posts_path)
         else:
             if use_test_data:
@@ -220,7 +245,7 @@ def index():
 
         # Fichier operations
         if operations_file_storage and operations_file_storage.filename:
-            operations_path = os.path.join(app.config['UPLOAD_FOLDER'], operations_file_storage.filename)
+            operations_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(operations_file_storage.filename))
             operations_file_storage.save(operations_path)
         else:
             if use_test_data:
@@ -231,7 +256,7 @@ def index():
 
         # Fichier post_unavailability
         if post_unavailability_file_storage and post_unavailability_file_storage.filename:
-            post_unavailability_path = os.path.join(app.config['UPLOAD_FOLDER'], post_unavailability_file_storage.filename)
+            post_unavailability_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(post_unavailability_file_storage.filename))
             post_unavailability_file_storage.save(post_unavailability_path)
         else:
             if use_test_data:
@@ -269,8 +294,10 @@ def index():
                 # return render_template('index.html', error=f"Échec du chargement des OFs depuis {besoins_path} ou fichier vide.")
 
 
-            bom_data = load_bom_from_file(nomenclature_path)
-            if not bom_data:
+            # Nomenclature compilée une seule fois (cache disque indexé par le contenu du fichier),
+            # partagée par le groupement et la consommation
+            bom_graph = load_bom_graph(nomenclature_path)
+            if not len(bom_graph):
                 app.logger.warning(f"Attention: Données de nomenclature depuis {nomenclature_path} vides ou échec du chargement.")
                 # Si la nomenclature est absolument requise, vous pouvez lever une erreur ici.
 
@@ -283,27 +310,63 @@ def index():
             # 2. Exécuter l'algorithme de groupement
             # Utiliser une valeur par défaut pour horizon_H_weeks_param si non configurable via formulaire
             horizon_weeks = horizon_weeks_val  # Utiliser la valeur du formulaire 
-            groups, all_ofs_with_groups = run_grouping_algorithm(
-                all_ofs if all_ofs else [], # Pass empty list if loading failed but we continue
-                bom_data if bom_data else [], # Pass empty list if loading failed
-                horizon_H_weeks_param=horizon_weeks 
-            )
 
-            # 3. Exécuter le lissage et la planification
-            final_updated_ofs = smooth_and_schedule_groups(
-                groups,
-                all_ofs_with_groups,
-                bom_data if bom_data else [],
-                posts_map,
-                operations_map,
-                params=smoothing_params # Contient output_file_path, log_file_path, etc.
+            # Recalcul incrémental : seules les familles touchées par le diff des besoins sont
+            # regroupées, à condition que les autres entrées soient celles de l'exécution précédente
+            input_fingerprint = (
+                tuple(file_content_hash(path) for path in (nomenclature_path, posts_path, operations_path, post_unavailability_path)),
+                horizon_weeks,
+                smoothing_params['advance_retreat_weeks'],
             )
+            previous_run = None
+            if request.form.get('incremental', 'false').lower() == 'true':
+                previous_run = PlanningRun.load(planning_run_path(input_fingerprint))
+                if previous_run is not None and previous_run.input_fingerprint != input_fingerprint:
+                    app.logger.info("Entrées modifiées depuis la dernière exécution : recalcul complet.")
+                    previous_run = None
+
+            if previous_run is not None:
+                planning_run = run_incremental_regrouping(
+                    previous_run,
+                    all_ofs if all_ofs else [],
+                    bom_graph,
+                    operations_map,
+                    params=smoothing_params
+                )
+                groups, final_updated_ofs = planning_run.groups, planning_run.all_ofs
+            else:
+                groups, all_ofs_with_groups = run_grouping_algorithm(
+                    all_ofs if all_ofs else [], # Pass empty list if loading failed but we continue
+                    bom_graph,
+                    horizon_H_weeks_param=horizon_weeks 
+                )
+
+                # 3. Exécuter le lissage et la planification
+                final_updated_ofs = smooth_and_schedule_groups(
+                    groups,
+                    all_ofs_with_groups,
+                    bom_graph,
+                    posts_map,
+                    operations_map,
+                    params=smoothing_params # Contient output_file_path, log_file_path, etc.
+                )
+                planning_run = PlanningRun(final_updated_ofs, groups, posts_map, horizon_weeks, smoothing_params, input_fingerprint)
+            try:
+                os.makedirs(RUNS_DIR, exist_ok=True)
+                planning_run.save(planning_run_path(input_fingerprint))
+                prune_planning_runs()
+            except OSError as e:
+                app.logger.warning(f"Impossible d'enregistrer l'exécution pour le recalcul incrémental : {e}")
             # 3.2. (NOUVEAU) recalculer les stocks individuels par groupe AVANT d'écrire
-            for g in groups:
-                # le nom exact dépend de ce que tu as dans sothemalgo_grouper
-                # j’utilise un nom générique que tu avais montré
-                if hasattr(g, "calculate_consumption"):
-                    g.calculate_consumption(bom_data if bom_data else [])
+            if request.form.get('net_inventory', 'false').lower() == 'true':
+                # netting usine : les surplus d'un groupe servent les groupes suivants
+                net_inventory_across_groups(groups, final_updated_ofs, bom_graph)
+            else:
+                for g in groups:
+                    # le nom exact dépend de ce que tu as dans sothemalgo_grouper
+                    # j’utilise un nom générique que tu avais montré
+                    if hasattr(g, "calculate_consumption"):
+                        g.calculate_consumption(bom_graph)
             # 3.5. Générer le fichier de sortie
             write_grouped_needs_to_file(smoothing_params['output_file_path'], groups, final_updated_ofs)
             
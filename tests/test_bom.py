@@ -0,0 +1,125 @@
+import os
+import pickle
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sothemalgo_grouper as sg
+
+
+def make_of(of_id, product_id, product_type, bom_level, need_date, quantity):
+    return sg.ManufacturingOrder(of_id, product_id, product_id, product_type, bom_level, need_date, quantity, "", "", "", "")
+
+
+def test_cyclic_bom_is_rejected():
+    bom = [sg.BOMEntry("PF-A", "SF-1", 1.0, 1), sg.BOMEntry("SF-1", "PF-A", 1.0, 0)]
+    with pytest.raises(ValueError, match="Cyclic BOM"):
+        sg.BOMGraph(bom)
+
+
+def test_inconsistent_child_level_is_reported(capsys):
+    bom_graph = sg.BOMGraph([sg.BOMEntry("PF-A", "SF-1", 1.0, 2), sg.BOMEntry("SF-1", "PMX-1", 1.0, 0)])
+    assert bom_graph.levels == {"PMX-1": 0, "SF-1": 1, "PF-A": 2}
+    out = capsys.readouterr().out
+    assert "1 BOM lines have a ChildBOMLevel inconsistent" in out
+    assert "SF-1 (declared 2, computed 1)" in out
+
+
+def test_consumption_orders_by_declared_level_and_warns_on_mismatch(capsys):
+    # PF-A est déclaré au niveau 1 alors que la nomenclature le place au niveau 2
+    bom_graph = sg.BOMGraph([sg.BOMEntry("PF-A", "SF-1", 1.0, 1), sg.BOMEntry("SF-1", "PMX-1", 1.0, 0)])
+    pmx = make_of("OF0", "PMX-1", "PS", 0, "2025-06-30", 20)
+    pf = make_of("OF1", "PF-A", "PF", 1, "2025-07-01", 10)
+    sf = make_of("OF2", "SF-1", "SF", 1, "2025-07-02", 10)
+    group = sg.Group("G1", "PMX-1", pmx, None, None)
+    group.add_of(pf)
+    group.add_of(sf)
+
+    group.calculate_consumption(bom_graph)
+
+    assert "1 OFs have a level inconsistent with the BOM: OF1 (declared 1, computed 2)" in capsys.readouterr().out
+    # même niveau déclaré : OF1 (date plus tôt) passe avant OF2 et ne trouve pas encore de SF-1
+    assert (pmx.individual_product_stock, pf.individual_product_stock, sf.individual_product_stock) == (10.0, 0.0, 10.0)
+
+
+def test_netting_does_not_reuse_stock_consumed_by_an_earlier_group(capsys):
+    bom = [sg.BOMEntry("PF-A", "CMP-1", 1.0, 0), sg.BOMEntry("PF-B", "CMP-1", 1.0, 0)]
+    cmp_of = make_of("OF1", "CMP-1", "PS", 0, "2025-06-02", 30)
+    first = [cmp_of, make_of("OF2", "PF-A", "PF", 1, "2025-06-10", 10)]
+    second = [make_of("OF3", "PF-B", "PF", 1, "2025-07-05", 25), make_of("OF4", "PF-A", "PF", 1, "2025-07-10", 15)]
+    groups = []
+    for number, (ofs, window_start) in enumerate([(first, datetime(2025, 6, 1)), (second, datetime(2025, 7, 1))], 1):
+        group = sg.Group(f"GRP{number}", "CMP-1", ofs[0], window_start, window_start + timedelta(weeks=4))
+        group.add_of(ofs[1])
+        groups.append(group)
+
+    ledger = sg.net_inventory_across_groups(groups, first + second, bom)
+    capsys.readouterr()
+
+    # calcul manuel : GRP1 produit 30 CMP-1 et en consomme 10 ; GRP2 ne voit que les 20 restants,
+    # insuffisants pour OF3 (25) mais suffisants pour OF4 (15), qui laisse 5 sur le lot de OF1
+    assert [of.individual_product_stock for of in first + second] == [5.0, 10.0, 0.0, 15.0]
+    assert ledger.on_hand("CMP-1") == pytest.approx(5.0)
+    assert groups[0].individual_product_stocks == {"CMP-1": 5.0, "PF-A": 10.0}
+    assert groups[1].individual_product_stocks == {"PF-B": 0.0, "PF-A": 15.0}
+
+
+def test_normalize_product_id_is_memoized_in_a_bounded_cache():
+    assert sg.normalize_product_id("\ufeff pmx 01 ") == "PMX01"
+    assert sg.normalize_product_id(None) == ""
+    assert sg._product_key.cache_info().maxsize == sg.PRODUCT_KEY_CACHE_SIZE
+
+
+BOM_CSV = "ParentProductID;ChildProductID;QuantityChildPerParent;ChildBOMLevel\nPF-A;SF-1;2;1\nSF-1;PMX-1;0.5;0\n"
+
+
+def load_cached_bom(path, cache_dir, capsys, **kwargs):
+    bom_graph = sg.load_bom_graph(str(path), cache_dir=str(cache_dir), **kwargs)
+    return bom_graph, capsys.readouterr().out
+
+
+def test_bom_cache_hits_and_is_invalidated_when_the_file_changes(tmp_path, capsys):
+    bom_path = tmp_path / "bom.csv"
+    cache_dir = tmp_path / "cache"
+    bom_path.write_text(BOM_CSV)
+
+    first, out = load_cached_bom(bom_path, cache_dir, capsys)
+    assert "[BOM CACHE] Hit" not in out
+    cached, out = load_cached_bom(bom_path, cache_dir, capsys)
+    assert "[BOM CACHE] Hit" in out
+    assert dict(cached.children) == dict(first.children) and cached.levels == first.levels
+
+    old_entry = sg._bom_cache_path(str(cache_dir), sg.file_content_hash(bom_path))
+    os.utime(old_entry, (0, 0))   # ordre LRU indépendant de la résolution des mtime
+    bom_path.write_text(BOM_CSV.replace("PF-A;SF-1;2;1", "PF-A;SF-1;3;1"))
+    changed, out = load_cached_bom(bom_path, cache_dir, capsys, max_entries=1)
+    assert "[BOM CACHE] Hit" not in out
+    assert changed.children["PF-A"] == [("SF-1", 3.0)]
+    # l'entrée de l'ancien contenu est évincée, celle du nouveau sert au chargement suivant
+    assert os.listdir(cache_dir) == [os.path.basename(sg._bom_cache_path(cache_dir, sg.file_content_hash(bom_path)))]
+    assert "[BOM CACHE] Hit" in load_cached_bom(bom_path, cache_dir, capsys)[1]
+
+
+@pytest.mark.parametrize("cache_content", [
+    b"not a pickle",
+    pickle.dumps((sg.BOM_CACHE_FORMAT_VERSION - 1, {})),   # ancien format
+    pickle.dumps(None),
+])
+def test_bom_cache_rebuilds_corrupt_or_stale_entries(tmp_path, capsys, cache_content):
+    bom_path = tmp_path / "bom.csv"
+    cache_dir = tmp_path / "cache"
+    bom_path.write_text(BOM_CSV)
+    cache_dir.mkdir()
+    cache_path = sg._bom_cache_path(str(cache_dir), sg.file_content_hash(bom_path))
+    with open(cache_path, "wb") as f:
+        f.write(cache_content)
+
+    rebuilt, out = load_cached_bom(bom_path, cache_dir, capsys)
+    assert "[BOM CACHE] Hit" not in out
+    assert rebuilt.levels == {"PMX-1": 0, "SF-1": 1, "PF-A": 2}
+    assert rebuilt.children["SF-1"] == [("PMX-1", 0.5)]
+    # l'entrée est réécrite au bon format
+    assert "[BOM CACHE] Hit" in load_cached_bom(bom_path, cache_dir, capsys)[1]
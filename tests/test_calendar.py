@@ -0,0 +1,124 @@
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sothemalgo_grouper as sg
+
+
+def make_post(*unavailable_days, **kwargs):
+    post = sg.Post("P1", "Poste 1", **kwargs)
+    for start, end in unavailable_days:
+        post.add_unavailable_period(start, end)
+    return post
+
+
+def minute_is_working(post, dt):
+    """Référence minute par minute : jour ouvré, horaires hors déjeuner, hors indisponibilités."""
+    if dt.weekday() >= 5 or any(start <= dt <= end for start, end in post.unavailable_periods):
+        return False
+    t = dt.time()
+    return post.work_start_time <= t < post.work_end_time and not post.lunch_start_time <= t < post.lunch_end_time
+
+
+def minute_scan_end(post, start, minutes):
+    dt = start
+    while True:
+        if minute_is_working(post, dt):
+            minutes -= 1
+            if minutes == 0:
+                return dt + timedelta(minutes=1)
+        dt += timedelta(minutes=1)
+
+
+@pytest.mark.parametrize("start, hours, expected", [
+    (datetime(2025, 7, 16, 11, 0), 2, datetime(2025, 7, 16, 14, 0)),     # pause déjeuner
+    (datetime(2025, 7, 11, 16, 0), 3, datetime(2025, 7, 16, 10, 0)),     # week-end puis lun.-mar. indisponibles
+    (datetime(2025, 7, 11, 16, 30), 0.5, datetime(2025, 7, 11, 17, 0)),  # fin pile en fin de journée
+    (datetime(2025, 9, 1, 8, 0), 400, datetime(2025, 11, 7, 17, 0)),     # au-delà de l'ancienne limite de 333 h
+])
+def test_end_datetime_skips_breaks_weekends_and_unavailability(start, hours, expected):
+    post = make_post(("2025-07-14", "2025-07-15"))
+    assert post.calculate_end_datetime(start, hours) == expected
+
+
+def test_end_datetime_matches_minute_scan():
+    rnd = random.Random(17)
+    post = make_post(("2025-07-09", "2025-07-10"), ("2025-07-22", "2025-07-22"), ("2025-07-21", "2025-07-25"))
+    for _ in range(40):
+        start = datetime(2025, 7, 1) + timedelta(minutes=rnd.randrange(31 * 1440))
+        minutes = rnd.randint(1, 3000)
+        assert post.calculate_end_datetime(start, minutes / 60) == minute_scan_end(post, start, minutes)
+
+
+@pytest.mark.parametrize("current, expected", [
+    (datetime(2025, 7, 11, 17, 30), datetime(2025, 7, 22, 8, 0)),   # vendredi soir, puis 14-18 et 21 indisponibles
+    (datetime(2025, 7, 16, 9, 0), datetime(2025, 7, 22, 8, 0)),
+    (datetime(2025, 7, 23, 12, 30), datetime(2025, 7, 23, 13, 0)),  # pause déjeuner
+    (datetime(2025, 7, 23, 9, 15, 30), datetime(2025, 7, 23, 9, 15)),
+])
+def test_next_working_datetime_crosses_merged_unavailability(current, expected):
+    # périodes qui se chevauchent, données dans le désordre
+    post = make_post(("2025-07-21", "2025-07-21"), ("2025-07-16", "2025-07-18"), ("2025-07-14", "2025-07-16"))
+    assert len(post.calendar._unavailable_starts) == 2
+    assert post._get_next_working_datetime(current) == expected
+    assert post._is_working_moment(expected)
+
+
+def test_next_working_datetime_matches_minute_scan():
+    rnd = random.Random(18)
+    post = make_post(("2025-07-09", "2025-07-10"), ("2025-07-10", "2025-07-11"), ("2025-07-28", "2025-08-08"))
+    for _ in range(60):
+        current = datetime(2025, 7, 1) + timedelta(minutes=rnd.randrange(31 * 1440))
+        expected = current
+        while not minute_is_working(post, expected):
+            expected += timedelta(minutes=1)
+        assert post._get_next_working_datetime(current) == expected
+
+
+@pytest.mark.parametrize("granularity, start, end", [
+    ("minute", datetime(2025, 7, 16, 8, 7), datetime(2025, 7, 16, 9, 14)),
+    ("quarter_hour", datetime(2025, 7, 16, 8, 15), datetime(2025, 7, 16, 9, 30)),
+    ("hour", datetime(2025, 7, 16, 9, 0), datetime(2025, 7, 16, 11, 0)),
+    ("shift", datetime(2025, 7, 17, 8, 0), datetime(2025, 7, 17, 17, 0)),   # journée entamée inutilisable
+])
+def test_granularity_rounds_start_up_and_duration_to_whole_units(granularity, start, end):
+    post = make_post(time_granularity=granularity)
+    assert post._get_next_working_datetime(datetime(2025, 7, 16, 8, 7)) == start
+    assert post.find_available_slot(datetime(2025, 7, 16, 8, 7), 1.1) == (start, end)
+
+
+def test_hour_granularity_drops_partially_unavailable_hours():
+    shift = make_post().shift
+    periods = [(datetime(2025, 7, 16, 10, 30), datetime(2025, 7, 16, 11, 10))]
+    by_minute = sg.working_calendar(shift, periods, "minute")
+    by_hour = sg.working_calendar(shift, periods, "hour")
+    assert by_minute.add_working_minutes(datetime(2025, 7, 16, 10, 0), 60) == datetime(2025, 7, 16, 11, 41)
+    # 10 h et 11 h entamées par l'indisponibilité, puis pause déjeuner
+    assert by_hour.next_working_datetime(datetime(2025, 7, 16, 10, 0)) == datetime(2025, 7, 16, 13, 0)
+    assert by_hour.add_working_minutes(datetime(2025, 7, 16, 9, 0), 120) == datetime(2025, 7, 16, 14, 0)
+
+
+def test_posts_share_calendars_by_shift_unavailability_and_granularity():
+    post_a = make_post(("2025-07-14", "2025-07-15"))
+    post_b = make_post(("2025-07-14", "2025-07-15"))
+    other_days = make_post(("2025-07-21", "2025-07-21"))
+    assert post_a.calendar is post_b.calendar
+    assert other_days.calendar is not post_a.calendar
+    assert other_days.calendar.shift is post_a.calendar.shift
+
+    shared = post_a.calendar
+    post_b.set_time_granularity("hour")
+    assert post_b.calendar is not shared and post_b.calendar.granularity == "hour"
+    assert post_a.calendar is shared
+
+    # une indisponibilité ajoutée après coup ne touche que son poste
+    post_a.add_unavailable_period("2025-07-28", "2025-07-28")
+    assert post_a.calendar is not shared
+    assert not post_a._is_working_moment(datetime(2025, 7, 28, 9, 0))
+    assert shared.is_working(datetime(2025, 7, 28, 9, 0))
+    assert sg.working_calendar(shared.shift, post_a.unavailable_periods) is post_a.calendar
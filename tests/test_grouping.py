@@ -0,0 +1,235 @@
+import copy
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sothemalgo_grouper as sg
+
+
+def make_of(of_id, product_id, need_date="2025-07-01", quantity=10, bom_level=1):
+    return sg.ManufacturingOrder(of_id, product_id, product_id, "PF", bom_level, need_date, quantity, "", "", "", "")
+
+
+@pytest.fixture
+def ofs():
+    return [make_of("OF1", "PF-A"), make_of("OF2", "PF-B", "2025-07-08")]
+
+
+def test_grouping_without_bom_returns_no_group(ofs):
+    groups, all_ofs = sg.run_grouping_algorithm(ofs, [], 10)
+    assert groups == []
+    assert all(of.assigned_group_id is None for of in all_ofs)
+
+
+def test_grouping_with_unrelated_bom_returns_no_group(ofs):
+    bom = [sg.BOMEntry("PF-X", "PMX-1", 2.0, 0)]
+    groups, _ = sg.run_grouping_algorithm(ofs, bom, 10)
+    assert groups == []
+
+
+@pytest.mark.skipif(sg.np is None, reason="NumPy non installé")
+def test_matrix_requirements_for_unknown_products(ofs):
+    bom_graph = sg.BOMGraph([sg.BOMEntry("PF-X", "PMX-1", 2.0, 0)])
+    assert sg.BOMMatrix(bom_graph).requirements_for_orders(ofs) == [{}, {}]
+
+
+def _assert_every_week_within_cap(post, cap_hours=35):
+    for start, end, _ in post.scheduled_slots:
+        for day, _ in post._day_loads(start, end):
+            assert post.weekly_load.get(sg._week_index(day)) <= cap_hours * 60
+
+
+@pytest.mark.parametrize("hours", [36, 60, 70])
+def test_weekly_capacity_places_long_operations(hours):
+    post = sg.Post("P1", "Poste 1", default_capacity_hours_week=35)
+    start, end = post.find_available_slot(datetime(2025, 7, 7, 8), hours, respect_weekly_capacity=True)
+    assert start is not None and start < datetime(2025, 7, 14)
+    post.book_slot(start, end, "OF1")
+    _assert_every_week_within_cap(post)
+
+
+@pytest.mark.parametrize("hours", [71, 200])
+def test_weekly_capacity_refuses_operation_that_never_fits(hours):
+    # plus de 70 h couvrent une semaine entière de 40 h : jamais sous 35 h/semaine
+    post = sg.Post("P1", "Poste 1", default_capacity_hours_week=35)
+    assert post.find_available_slot(datetime(2025, 7, 7, 8), hours, respect_weekly_capacity=True) == (None, None)
+    assert post.find_latest_slot(datetime(2025, 12, 26, 17), hours, datetime(2025, 7, 1), respect_weekly_capacity=True) == (None, None)
+
+
+def test_weekly_capacity_checks_middle_weeks_with_existing_load():
+    post = sg.Post("P1", "Poste 1", default_capacity_hours_week=38)
+    post.book_slot(datetime(2025, 7, 14, 8), datetime(2025, 7, 14, 12), "OF0")
+    start, end = post.find_available_slot(datetime(2025, 7, 7, 8), 60, respect_weekly_capacity=True)
+    assert start is not None
+    post.book_slot(start, end, "OF1")
+    _assert_every_week_within_cap(post, 38)
+
+
+def test_weekly_capacity_backward_places_long_operation():
+    post = sg.Post("P1", "Poste 1", default_capacity_hours_week=35)
+    start, end = post.find_latest_slot(datetime(2025, 9, 26, 17), 60, datetime(2025, 7, 1), respect_weekly_capacity=True)
+    assert end is not None and end > datetime(2025, 9, 22)
+    post.book_slot(start, end, "OF1")
+    _assert_every_week_within_cap(post)
+
+
+def test_first_fit_skips_short_gaps_and_reuses_released_slot():
+    post = sg.Post("P1", "Poste 1", default_capacity_hours_week=0)
+    current = datetime(2025, 7, 7, 8)
+    for i in range(20):
+        start, end = post.find_available_slot(current, 1)
+        post.book_slot(start, end, f"OP{i}")
+        current = end + timedelta(minutes=30)
+    start, _ = post.find_available_slot(datetime(2025, 7, 7, 8), 2)
+    assert start >= post.scheduled_slots[-1][1]
+    post.clear_schedule_for_of("OP3")
+    post.clear_schedule_for_of("OP4")
+    booked = {key: (s, e) for s, e, key in post.scheduled_slots}
+    start, end = post.find_available_slot(datetime(2025, 7, 7, 8), 2)
+    assert booked["OP2"][1] <= start and end <= booked["OP5"][0]
+
+
+def test_streaming_pipeline_rejects_dispatch_engine(ofs):
+    pipeline = sg.iter_grouping_pipeline(ofs, [], 10, {}, {}, {"scheduling_engine": "dispatch"})
+    with pytest.raises(ValueError):
+        next(pipeline)
+
+
+def test_parameter_sweep_keeps_requested_order_and_values(ofs):
+    combinations = [(4, 1), (2.5, 0.5), (4, 1)]
+    results = sg.run_parameter_sweep(ofs, [], {}, {}, combinations)
+    assert [(r["horizon_H_weeks"], r["advance_retreat_weeks"]) for r in results] == combinations
+    assert results[0] == results[2] and results[0] is not results[2]
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads")
+
+
+def load_sample_ofs():
+    return sg.load_ofs_from_file(os.path.join(SAMPLE_DIR, "test_besoins_client.csv"))
+
+
+@pytest.fixture
+def sample_inputs(capsys):
+    bom_graph = sg.BOMGraph(sg.load_bom_from_file(os.path.join(SAMPLE_DIR, "test_nomenclature_client.csv")))
+    posts_map, operations_map = sg.load_posts_and_operations_data(
+        os.path.join(SAMPLE_DIR, "test_posts_client.csv"),
+        os.path.join(SAMPLE_DIR, "absent.csv"),
+        os.path.join(SAMPLE_DIR, "test_operations_client.csv"),
+    )
+    capsys.readouterr()
+    return bom_graph, posts_map, operations_map
+
+
+def group_signature(groups):
+    return [(group.id, [(of.id, of.need_date) for of in group.ofs]) for group in groups]
+
+
+@pytest.mark.parametrize("changed_row", [5, -1])
+def test_incremental_regrouping_matches_full_run_with_duplicate_codes(sample_inputs, changed_row):
+    bom_graph, posts_map, operations_map = sample_inputs
+
+    def extraction(changed):
+        ofs = load_sample_ofs()
+        duplicate = copy.copy(ofs[20])   # même Order Code, autre ligne
+        duplicate.need_date += timedelta(days=3)
+        ofs.append(duplicate)
+        if changed:
+            ofs[changed_row].need_date += timedelta(days=10)
+        return ofs
+
+    groups, all_ofs = sg.run_grouping_algorithm(extraction(False), bom_graph, 10)
+    scheduled_ofs = sg.smooth_and_schedule_groups(groups, all_ofs, bom_graph, posts_map, operations_map, {})
+    previous_run = sg.PlanningRun(scheduled_ofs, groups, posts_map, 10)
+
+    run = sg.run_incremental_regrouping(previous_run, extraction(True), bom_graph, operations_map)
+    full_groups, full_ofs = sg.run_grouping_algorithm(extraction(True), bom_graph, 10)
+
+    assert group_signature(run.groups) == group_signature(full_groups)
+    assert len({id(of) for of in run.all_ofs}) == len(run.all_ofs)
+    assert [of.assigned_group_id for of in run.all_ofs] == [of.assigned_group_id for of in full_ofs]
+
+
+def test_parameter_sweep_matches_full_run_on_processed_inputs(sample_inputs, capsys):
+    bom_graph, posts_map, operations_map = sample_inputs
+    params = {"advance_retreat_weeks": 3}
+    groups, all_ofs = sg.run_grouping_algorithm(load_sample_ofs(), bom_graph, 10)
+    scheduled = sg.smooth_and_schedule_groups(groups, all_ofs, bom_graph, posts_map, operations_map, params)
+    capsys.readouterr()
+
+    # entrées déjà traitées : OFs affectés et planifiés, postes réservés
+    [summary] = sg.run_parameter_sweep(scheduled, bom_graph, posts_map, operations_map, [(10, 3)])
+
+    statuses = [of.status for of in scheduled]
+    assert summary == {
+        "horizon_H_weeks": 10,
+        "advance_retreat_weeks": 3,
+        "groups": len(groups),
+        "planned_ofs": statuses.count("PLANNED"),
+        "planned_outside_window_ofs": statuses.count("PLANNED_OUTSIDE_WINDOW"),
+        "failed_ofs": statuses.count("FAILED_PLANNING") + statuses.count("FAILED_PLANNING_NO_OPS"),
+        "unassigned_ofs": sum(1 for of in scheduled if of.assigned_group_id is None),
+        "total_delay_days": sum(
+            max(0, (of.scheduled_start_date - of.need_date).days) for of in scheduled if of.scheduled_start_date
+        ),
+    }
+    assert summary["planned_ofs"] > 0
+
+
+def test_date_index_matches_linear_scan_with_ties_and_duplicate_codes():
+    rnd = random.Random(5)
+    products = ["PMX-1", "PMX-2", "SF-1"]
+    # peu de dates distinctes (égalités) et des Order Codes répétés
+    ofs = [
+        make_of(f"OF{rnd.randint(1, 15)}", rnd.choice(products), f"2025-07-{rnd.randint(1, 6):02d}")
+        for _ in range(60)
+    ]
+    index = sg.OFDateIndex(ofs)
+
+    def free(product_id):
+        return [of for of in ofs if of.assigned_group_id is None and of.product_key == product_id]
+
+    for _ in range(300):
+        of = rnd.choice(ofs)
+        if of.assigned_group_id is None:
+            of.assigned_group_id = "GRP1"
+            index.mark_assigned(of)
+        else:
+            of.assigned_group_id = None
+            index.mark_unassigned(of)
+
+        product_id = rnd.choice(products)
+        target = datetime(2025, 7, rnd.randint(1, 8))
+        end = target + timedelta(days=rnd.randint(0, 3))
+        candidates = free(product_id)
+        nearest = min(candidates, key=lambda x: abs((x.need_date - target).days)) if candidates else None
+        earliest = min(candidates, key=lambda x: x.need_date) if candidates else None
+        assert index.nearest_unassigned(product_id, target) is nearest
+        assert index.earliest_unassigned(product_id) is earliest
+        in_range = index.unassigned_in_range(product_id, target, end)
+        assert [id(x) for x in in_range] == [id(x) for x in candidates if target <= x.need_date <= end]
+        in_window = index.unassigned_in_window(target, end)
+        expected = sorted(
+            (x for x in ofs if x.assigned_group_id is None and target <= x.need_date <= end),
+            key=lambda x: x.need_date,
+        )
+        assert [id(x) for x in in_window] == [id(x) for x in expected]
+
+
+def test_parallel_grouping_matches_sequential_numbering(sample_inputs):
+    bom_graph, _, _ = sample_inputs
+    assert len(sg.partition_ofs_by_family(load_sample_ofs(), bom_graph)) > 1
+
+    sequential_groups, sequential_ofs = sg.run_grouping_algorithm(load_sample_ofs(), bom_graph, 10)
+    parallel_groups, parallel_ofs = sg.run_grouping_algorithm(load_sample_ofs(), bom_graph, 10, parallel_workers=2)
+
+    assert group_signature(parallel_groups) == group_signature(sequential_groups)
+    assert [(g.time_window_start, g.time_window_end) for g in parallel_groups] == [
+        (g.time_window_start, g.time_window_end) for g in sequential_groups
+    ]
+    assert [of.assigned_group_id for of in parallel_ofs] == [of.assigned_group_id for of in sequential_ofs]
@@ -0,0 +1,91 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sothemalgo_grouper as sg
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads")
+DISPATCH = {"scheduling_engine": "dispatch"}
+
+
+def make_of(of_id, product_id, need_date="2025-07-01", quantity=10, bom_level=1, product_type="PF"):
+    return sg.ManufacturingOrder(of_id, product_id, product_id, product_type, bom_level, need_date, quantity, "", "", "", "")
+
+
+def make_group(ofs, window_start=datetime(2025, 6, 2)):
+    group = sg.Group("GRP1", "PMX-1", ofs[0], window_start, datetime(2025, 8, 1))
+    for of in ofs[1:]:
+        group.add_of(of)
+    for of in ofs:
+        of.assigned_group_id = group.id
+    return group
+
+
+def assert_no_overlap(posts_map):
+    for post in posts_map.values():
+        slots = post.scheduled_slots
+        for (_, end, _), (start, _, _) in zip(slots, slots[1:]):
+            assert end <= start
+
+
+def test_dispatch_on_sample_books_no_overlap_and_sets_final_statuses(capsys):
+    bom = sg.load_bom_from_file(os.path.join(SAMPLE_DIR, "test_nomenclature_client.csv"))
+    ofs = sg.load_ofs_from_file(os.path.join(SAMPLE_DIR, "test_besoins_client.csv"))
+    posts_map, operations_map = sg.load_posts_and_operations_data(
+        os.path.join(SAMPLE_DIR, "test_posts_client.csv"),
+        os.path.join(SAMPLE_DIR, "absent.csv"),
+        os.path.join(SAMPLE_DIR, "test_operations_client.csv"),
+    )
+    groups, all_ofs = sg.run_grouping_algorithm(ofs, bom, 10)
+    scheduled = sg.smooth_and_schedule_groups(groups, all_ofs, bom, posts_map, operations_map, DISPATCH)
+    capsys.readouterr()
+
+    assert_no_overlap(posts_map)
+    final = {"PLANNED", "PLANNED_OUTSIDE_WINDOW", "FAILED_PLANNING", "FAILED_PLANNING_NO_OPS"}
+    for of in scheduled:
+        if of.assigned_group_id is None:
+            assert of.status == "UNASSIGNED"
+            continue
+        assert of.status in final
+        if of.status.startswith("PLANNED"):
+            assert of.scheduled_start_date < of.scheduled_end_date
+    assert any(of.status == "PLANNED" for of in scheduled)
+
+
+def test_dispatch_serves_ready_operations_by_priority(capsys):
+    posts_map = {"P1": sg.Post("P1", "Poste 1")}
+    operations_map = {"PF": [sg.Operation("PF", "OP1", "P1", 4, 1, 1)]}
+    # tous prêts au début de la fenêtre : niveau décroissant, puis date de besoin, puis rang
+    ofs = [
+        make_of("OF1", "PF-A", "2025-06-20", bom_level=1),
+        make_of("OF2", "PF-B", "2025-06-18", bom_level=1),
+        make_of("OF3", "PF-C", "2025-06-25", bom_level=2),
+        make_of("OF4", "PF-D", "2025-06-18", bom_level=1),
+    ]
+    group = make_group(ofs)
+    sg.smooth_and_schedule_groups([group], ofs, [], posts_map, operations_map, dict(DISPATCH, advance_retreat_weeks=4))
+    capsys.readouterr()
+
+    assert [of_key for _, _, of_key in posts_map["P1"].scheduled_slots] == ["OF3_OP1", "OF2_OP1", "OF4_OP1", "OF1_OP1"]
+    assert all(of.status == "PLANNED" for of in ofs)
+    assert_no_overlap(posts_map)
+
+
+def test_dispatch_failure_releases_earlier_bookings(capsys):
+    posts_map = {"P1": sg.Post("P1", "Poste 1"), "P2": sg.Post("P2", "Poste 2")}
+    operations_map = {
+        "PF-A": [sg.Operation("PF-A", "OP1", "P1", 4, 1, 1), sg.Operation("PF-A", "OP2", "P2", 200, 2, 1)],
+        "PF": [sg.Operation("PF", "OP1", "P1", 4, 1, 1)],
+    }
+    ofs = [make_of("OF1", "PF-A", "2025-06-18"), make_of("OF2", "PF-B", "2025-06-20")]
+    group = make_group(ofs)
+    sg.smooth_and_schedule_groups([group], ofs, [], posts_map, operations_map, dict(DISPATCH, advance_retreat_weeks=4))
+    capsys.readouterr()
+
+    assert [of.status for of in ofs] == ["FAILED_PLANNING", "PLANNED"]
+    assert [of_key for _, _, of_key in posts_map["P1"].scheduled_slots] == ["OF2_OP1"]
+    assert posts_map["P2"].scheduled_slots == []